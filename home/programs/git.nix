@@ -159,6 +159,10 @@
         # Amend the currently staged files to the latest commit
         amend = "commit --amend --reuse-message=HEAD";
 
+        # Start generating the AI commit message for the staged changes in the
+        # background; the prepare-commit-msg hook picks it up on commit.
+        prewarm = "!\"$HOME/.config/git/hooks/prepare-commit-msg\" prewarm";
+
         # Credit an author on the latest commit
         credit = "!f() { git commit --amend --author \"$1 <$2>\" -C HEAD; }; f";
 
@@ -0,0 +1,507 @@
+#!/usr/bin/env python3
+"""Offline benchmark for scripts/update-pins.py.
+
+Builds a throwaway world next to a copy of the repo's flake and pkgs:
+
+- bare git repos with thousands of synthetic tags, read over file:// (git's
+  url.<base>.insteadOf maps the github base onto them, so get_tags runs the
+  same ls-remote it would against GitHub);
+- a local HTTP server standing in for the npm registry, raw.githubusercontent
+  and the archive host;
+- a fake `nix` on PATH with configurable latency that prints fixed-output
+  hash mismatches for npmDeps builds (and hashes archives, should
+  update-pins ever fall back to nix prefetch).
+
+Each scenario imports a fresh copy of update-pins and times main() end to
+end. Results are appended to a JSON lines file and compared with the last
+run that used the same parameters, so slowdowns show up.
+"""
+
+import argparse
+import base64
+import contextlib
+import hashlib
+import importlib.util
+import io
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tarfile
+import tempfile
+import threading
+import time
+from collections.abc import Sequence
+from datetime import UTC, datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from types import ModuleType
+
+REPO_ROOT = Path(__file__).resolve().parents[1]
+SCRIPT_PATH = REPO_ROOT / "scripts" / "update-pins.py"
+# What update-pins reads and writes, copied into the world for every run.
+WORLD_FILES = ("flake.nix", "flake.lock", "pkgs")
+RESULTS_PATH = (
+    Path(os.environ.get("XDG_CACHE_HOME", Path.home() / ".cache"))
+    / "global-nix"
+    / "update-pins"
+    / "bench.jsonl"
+)
+
+DEFAULT_TAGS = 3000
+DEFAULT_NPM_PACKAGES = 400
+DEFAULT_REPEAT = 3
+DEFAULT_NIX_LATENCY = 0.05
+DEFAULT_BUILD_LATENCY = 0.5
+DEFAULT_HTTP_LATENCY = 0.002
+# Files in every synthetic source archive.
+ARCHIVE_FILES = 200
+# Flag a scenario when its median is this much slower than last time...
+REGRESSION_RATIO = 0.2
+# ...and by at least this many seconds, so noise on tiny runs is ignored.
+REGRESSION_MIN_SECONDS = 0.05
+
+# Every synthetic latest version is far above anything actually pinned, so
+# each target has work to do.
+LATEST_VERSION = "90.9.9"
+REPOS = {
+    "openai/codex": "rust-v",
+    "homebridge/homebridge": "v",
+    "tw93/Mole": "V",
+    "ramp-public/ramp-cli": "v",
+}
+
+FAKE_NIX = r'''#!{python}
+"""Stand-in for nix used by bench-update-pins.py."""
+import base64, hashlib, json, os, re, sys, time
+from urllib.request import urlopen
+
+args = sys.argv[1:]
+if args[:2] == ["store", "prefetch-file"]:
+    time.sleep(float(os.environ.get("FAKE_NIX_LATENCY", "0")))
+    with urlopen(args[-1]) as response:
+        digest = hashlib.sha256(response.read()).digest()
+    print(json.dumps({{"hash": "sha256-" + base64.b64encode(digest).decode()}}))
+elif args[:1] == ["build"]:
+    time.sleep(float(os.environ.get("FAKE_NIX_BUILD_LATENCY", "0")))
+    expr = args[args.index("--expr") + 1]
+    paths = dict(re.findall(r"(\w+) = \(pkgs\.callPackage \./(\S+) \{{\}}\)", expr))
+    for attr in args[args.index("--expr") + 2 :]:
+        text = open(paths[attr], encoding="utf-8").read()
+        version = re.search(r'version = "([^"]+)"', text).group(1)
+        got = base64.b64encode(hashlib.sha256(f"{{attr}}{{version}}".encode()).digest())
+        print(
+            "error: hash mismatch in fixed-output derivation "
+            f"'/nix/store/00000000000000000000000000000000-{{attr}}-{{version}}-npm-deps.drv':\n"
+            "         specified: sha256-AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA=\n"
+            f"            got:    sha256-{{got.decode()}}",
+            file=sys.stderr,
+        )
+    sys.exit(1)
+elif args[:2] == ["flake", "update"]:
+    time.sleep(float(os.environ.get("FAKE_NIX_LATENCY", "0")))
+else:
+    sys.exit(f"fake nix: unsupported command {{args}}")
+'''
+
+
+def synthetic_versions(count: int) -> list[str]:
+    versions = [f"{i // 1000}.{i // 10 % 100}.{i % 10}" for i in range(count - 1)]
+    return [*versions, LATEST_VERSION]
+
+
+def make_tag_repo(path: Path, prefix: str, tags: int) -> None:
+    """A bare repo with `tags` release tags plus as many non-matching ones."""
+    subprocess.run(["git", "init", "-q", "--bare", str(path)], check=True)
+
+    def git(*args: str, stdin: str = "") -> str:
+        return subprocess.run(
+            ["git", "-C", str(path), *args],
+            input=stdin,
+            text=True,
+            capture_output=True,
+            check=True,
+            env={
+                **os.environ,
+                "GIT_AUTHOR_NAME": "bench",
+                "GIT_AUTHOR_EMAIL": "bench@localhost",
+                "GIT_COMMITTER_NAME": "bench",
+                "GIT_COMMITTER_EMAIL": "bench@localhost",
+            },
+        ).stdout.strip()
+
+    tree = git("mktree")
+    commit = git("commit-tree", tree, "-m", "bench")
+    refs = [f"{prefix}{version}" for version in synthetic_versions(tags)]
+    refs += [f"nightly-{i}" for i in range(tags)]
+    git(
+        "update-ref",
+        "--stdin",
+        stdin="".join(f"create refs/tags/{ref} {commit}\n" for ref in refs),
+    )
+
+
+def archive(path: str) -> bytes:
+    """A stable .tar.gz for an archive URL path.
+
+    Tag archives get GitHub's single top-level directory; release assets
+    are a flat set of binaries (fetchzip stripRoot = false).
+    """
+    seed = hashlib.sha256(path.encode()).digest()
+    top = "" if "/releases/download/" in path else "src-" + seed.hex()[:7] + "/"
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode="w:gz") as tar:
+        for i in range(ARCHIVE_FILES):
+            data = hashlib.sha512(seed + bytes([i])).digest() * 32
+            info = tarfile.TarInfo(f"{top}dir{i % 8}/file{i}")
+            info.size = len(data)
+            info.mode = 0o755 if i % 5 == 0 else 0o644
+            tar.addfile(info, io.BytesIO(data))
+    return buf.getvalue()
+
+
+def npm_lock(base: str, packages: int) -> tuple[str, dict[str, bytes]]:
+    """A lockfile v3 with `packages` registry deps, and the tarballs it names."""
+    tarballs: dict[str, bytes] = {}
+    entries: dict[str, object] = {"": {"name": "bench", "version": LATEST_VERSION}}
+    for i in range(packages):
+        name = f"bench-pkg-{i}"
+        path = f"/registry/{name}/-/{name}-1.0.0.tgz"
+        data = hashlib.sha512(name.encode()).digest() * 64
+        tarballs[path] = data
+        integrity = base64.b64encode(hashlib.sha512(data).digest()).decode()
+        entries[f"node_modules/{name}"] = {
+            "version": "1.0.0",
+            "resolved": f"{base}{path}",
+            "integrity": f"sha512-{integrity}",
+        }
+    lock = {"name": "bench", "lockfileVersion": 3, "packages": entries}
+    return json.dumps(lock, indent=2), tarballs
+
+
+class StandIn(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, latency: float) -> None:
+        super().__init__(("127.0.0.1", 0), Handler)
+        self.latency = latency
+        self.routes: dict[str, bytes] = {}
+        self.requests = 0
+
+    @property
+    def base(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+
+class Handler(BaseHTTPRequestHandler):
+    server: StandIn
+    protocol_version = "HTTP/1.1"
+    # Headers and body go out as separate writes; without this, Nagle plus
+    # delayed ACKs add ~40ms to every keep-alive response.
+    disable_nagle_algorithm = True
+
+    def do_GET(self) -> None:
+        self.server.requests += 1
+        time.sleep(self.server.latency)
+        path = self.path.split("?", 1)[0]
+        body = self.server.routes.get(path)
+        if body is None and path.startswith("/github/") and path.endswith(".tar.gz"):
+            body = self.server.routes.setdefault(path, archive(path))
+        if body is None:
+            self.send_error(404)
+            return
+        etag = f'"{hashlib.sha1(body).hexdigest()}"'
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("ETag", etag)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format: str, *args: object) -> None:
+        pass
+
+
+class World:
+    """A repo copy, tag repos, HTTP stand-in and fake nix under one tempdir."""
+
+    def __init__(self, root: Path, args: argparse.Namespace) -> None:
+        self.root = root
+        self.repo = root / "repo"
+        self.server = StandIn(args.http_latency)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        base = self.server.base
+
+        (self.repo / "scripts").mkdir(parents=True)
+        shutil.copy2(SCRIPT_PATH, self.repo / "scripts" / SCRIPT_PATH.name)
+        for name in WORLD_FILES:
+            source = REPO_ROOT / name
+            if source.is_dir():
+                shutil.copytree(source, self.repo / name)
+            else:
+                shutil.copy2(source, self.repo / name)
+        self.snapshot = {
+            path: path.read_bytes() for path in self.repo.rglob("*") if path.is_file()
+        }
+
+        for repo, prefix in REPOS.items():
+            make_tag_repo(root / "git" / f"{repo}.git", prefix, args.tags)
+
+        routes = self.server.routes
+        routes["/npm/@scrypted%2Fserver"] = json.dumps(
+            {"name": "@scrypted/server", "dist-tags": {"latest": LATEST_VERSION}}
+        ).encode()
+        lock_text, tarballs = npm_lock(base, args.npm_packages)
+        # homebridge takes the direct npmDepsHash path; scrypted's lockfile is
+        # left unserved so it exercises the batched nix build fallback.
+        routes[f"/raw/homebridge/homebridge/v{LATEST_VERSION}/package-lock.json"] = (
+            lock_text.encode()
+        )
+        routes.update(tarballs)
+
+        bin_dir = root / "bin"
+        bin_dir.mkdir()
+        nix = bin_dir / "nix"
+        nix.write_text(FAKE_NIX.format(python=sys.executable), encoding="utf-8")
+        nix.chmod(0o755)
+
+        os.environ.update(
+            PATH=f"{bin_dir}{os.pathsep}{os.environ.get('PATH', '')}",
+            FAKE_NIX_LATENCY=str(args.nix_latency),
+            FAKE_NIX_BUILD_LATENCY=str(args.build_latency),
+            # Both the stand-in github base and flake.lock's real codex URL
+            # resolve to the local tag repos.
+            GIT_CONFIG_COUNT="2",
+            GIT_CONFIG_KEY_0=f"url.file://{root / 'git'}/.insteadOf",
+            GIT_CONFIG_VALUE_0=f"{base}/github/",
+            GIT_CONFIG_KEY_1=f"url.file://{root / 'git'}/.insteadOf",
+            GIT_CONFIG_VALUE_1="https://github.com/",
+        )
+        self.upstreams = {
+            "github": f"{base}/github",
+            "raw": f"{base}/raw",
+            "npm": f"{base}/npm",
+        }
+
+    def reset(self) -> None:
+        for path, data in self.snapshot.items():
+            path.write_bytes(data)
+
+    def load(self, cache: Path) -> ModuleType:
+        """Import a fresh update-pins so no in-memory state carries over."""
+        os.environ["XDG_CACHE_HOME"] = str(cache)
+        spec = importlib.util.spec_from_file_location(
+            "update_pins_bench", self.repo / "scripts" / SCRIPT_PATH.name
+        )
+        assert spec is not None and spec.loader is not None
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        module.UPSTREAMS.update(self.upstreams)
+        return module
+
+    def run(self, argv: Sequence[str], cache: Path) -> tuple[float, int, str]:
+        self.reset()
+        module = self.load(cache)
+        output = io.StringIO()
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(output), contextlib.redirect_stderr(output):
+            rc = module.main(list(argv))
+        return time.perf_counter() - start, rc, output.getvalue()
+
+    def close(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def scenarios(names: Sequence[str]) -> list[tuple[str, list[str], bool]]:
+    """(name, argv, warm cache) for every scenario."""
+    items = [
+        ("all", ["all"], False),
+        ("all-warm", ["all"], True),
+        ("check", ["--check", "all"], False),
+    ]
+    items += [(f"target:{name}", [name], False) for name in names]
+    return items
+
+
+def run_scenarios(world: World, repeat: int) -> dict[str, dict[str, object]]:
+    names = list(world.load(world.root / "cache-probe").PINS)
+    results: dict[str, dict[str, object]] = {}
+    for name, argv, warm in scenarios(names):
+        times = []
+        for attempt in range(repeat):
+            cache = world.root / f"cache-{name}-{0 if warm else attempt}"
+            if warm and attempt == 0:
+                world.run(argv, cache)
+            seconds, rc, output = world.run(argv, cache)
+            # --check exits 1 when something is outdated, which is expected here.
+            expected = 1 if "--check" in argv else 0
+            if rc != expected:
+                raise SystemExit(f"{name}: update-pins exited {rc}\n{output}")
+            times.append(seconds)
+        results[name] = {
+            "median": statistics.median(times),
+            "min": min(times),
+            "runs": times,
+        }
+        print(f"  {name:<18} {statistics.median(times):7.3f}s", flush=True)
+    return results
+
+
+def previous_run(path: Path, params: dict[str, object]) -> dict[str, object] | None:
+    try:
+        lines = path.read_text(encoding="utf-8").splitlines()
+    except OSError:
+        return None
+    for line in reversed(lines):
+        try:
+            record = json.loads(line)
+        except ValueError:
+            continue
+        if record.get("params") == params:
+            return record
+    return None
+
+
+def compare(
+    results: dict[str, dict[str, object]], previous: dict[str, object] | None
+) -> list[str]:
+    """Print results against the previous run; return regressed scenarios."""
+    before = previous.get("results", {}) if previous else {}
+    assert isinstance(before, dict)
+    regressed = []
+    print(f"  {'scenario':<18} {'median':>8} {'min':>8} {'previous':>9} {'change':>7}")
+    for name, result in results.items():
+        median = float(result["median"])  # type: ignore[arg-type]
+        line = f"  {name:<18} {median:7.3f}s {float(result['min']):7.3f}s"  # type: ignore[arg-type]
+        old = before.get(name)
+        if isinstance(old, dict):
+            old_median = float(old["median"])
+            change = (median - old_median) / old_median if old_median else 0.0
+            line += f" {old_median:8.3f}s {change:+6.0%}"
+            if (
+                change > REGRESSION_RATIO
+                and median - old_median > REGRESSION_MIN_SECONDS
+            ):
+                regressed.append(name)
+                line += "  slower"
+        print(line)
+    return regressed
+
+
+def git_rev() -> str:
+    result = subprocess.run(
+        ["git", "-C", str(REPO_ROOT), "rev-parse", "--short", "HEAD"],
+        capture_output=True,
+        text=True,
+        check=False,
+    )
+    dirty = subprocess.run(
+        ["git", "-C", str(REPO_ROOT), "diff", "--quiet", "--", str(SCRIPT_PATH)],
+        check=False,
+    )
+    rev = result.stdout.strip() or "unknown"
+    return f"{rev}-dirty" if dirty.returncode else rev
+
+
+def parse_args(argv: Sequence[str]) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description="Benchmark update-pins against local stand-ins."
+    )
+    parser.add_argument(
+        "--tags",
+        type=int,
+        default=DEFAULT_TAGS,
+        help=f"Release tags per repo, plus as many others (default: {DEFAULT_TAGS}).",
+    )
+    parser.add_argument(
+        "--npm-packages",
+        type=int,
+        default=DEFAULT_NPM_PACKAGES,
+        help=f"Dependencies in the homebridge lockfile (default: {DEFAULT_NPM_PACKAGES}).",
+    )
+    parser.add_argument(
+        "--repeat",
+        type=int,
+        default=DEFAULT_REPEAT,
+        help=f"Timed runs per scenario (default: {DEFAULT_REPEAT}).",
+    )
+    parser.add_argument(
+        "--nix-latency",
+        type=float,
+        default=DEFAULT_NIX_LATENCY,
+        help=f"Seconds per fake nix prefetch/flake call (default: {DEFAULT_NIX_LATENCY:g}).",
+    )
+    parser.add_argument(
+        "--build-latency",
+        type=float,
+        default=DEFAULT_BUILD_LATENCY,
+        help=f"Seconds per fake nix build (default: {DEFAULT_BUILD_LATENCY:g}).",
+    )
+    parser.add_argument(
+        "--http-latency",
+        type=float,
+        default=DEFAULT_HTTP_LATENCY,
+        help=f"Seconds added to each HTTP response (default: {DEFAULT_HTTP_LATENCY:g}).",
+    )
+    parser.add_argument(
+        "--results",
+        type=Path,
+        default=RESULTS_PATH,
+        help=f"JSON lines file to append results to (default: {RESULTS_PATH}).",
+    )
+    parser.add_argument(
+        "--no-record",
+        action="store_true",
+        help="Compare against earlier results without appending this run.",
+    )
+    return parser.parse_args(argv)
+
+
+def main(argv: Sequence[str]) -> int:
+    args = parse_args(argv)
+    params = {
+        "tags": args.tags,
+        "npm_packages": args.npm_packages,
+        "nix_latency": args.nix_latency,
+        "build_latency": args.build_latency,
+        "http_latency": args.http_latency,
+    }
+    with tempfile.TemporaryDirectory(prefix="bench-update-pins-") as tmp:
+        print("building stand-ins...", flush=True)
+        world = World(Path(tmp), args)
+        try:
+            print("running:", flush=True)
+            results = run_scenarios(world, max(1, args.repeat))
+        finally:
+            world.close()
+
+    previous = previous_run(args.results, params)
+    print("results:")
+    regressed = compare(results, previous)
+    if not args.no_record:
+        record = {
+            "time": datetime.now(UTC).isoformat(timespec="seconds"),
+            "rev": git_rev(),
+            "python": sys.version.split()[0],
+            "params": params,
+            "results": results,
+        }
+        args.results.parent.mkdir(parents=True, exist_ok=True)
+        with args.results.open("a", encoding="utf-8") as handle:
+            handle.write(json.dumps(record, sort_keys=True) + "\n")
+    if regressed:
+        print(f"slower than last run: {', '.join(regressed)}", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main(sys.argv[1:]))
@@ -1,15 +1,21 @@
 #!/usr/bin/env python3
+import atexit
+import fcntl
+import hashlib
 import json
 import os
 import re
 import subprocess
 import sys
+import threading
+import time
 import urllib.request
 from urllib.error import HTTPError
-from typing import Optional, Sequence, Union, Literal
+from typing import IO, Callable, Self, Sequence, Union, Literal
 import textwrap
 from pathlib import Path
 from contextlib import suppress
+from datetime import UTC, datetime
 
 # Pretty terminal rendering for Markdown reasoning (always available via flake)
 # Pretty terminal rendering for Markdown reasoning (if available). Fallback to
@@ -59,7 +65,46 @@ TRAILER_PREFIXES = (
     "see-also:",
     "fixes:",
 )
-DIFF_MAX_CHARS = 40_000
+# Rough prompt budget for the diff; code averages about 4 chars per token.
+DIFF_TOKEN_BUDGET = 10_000
+CHARS_PER_TOKEN = 4
+# Files only summarized (path and line counts), never sent in full.
+LOCKFILE_NAMES = frozenset(
+    {
+        "Cargo.lock",
+        "Gemfile.lock",
+        "composer.lock",
+        "flake.lock",
+        "go.sum",
+        "package-lock.json",
+        "pnpm-lock.yaml",
+        "poetry.lock",
+        "uv.lock",
+        "yarn.lock",
+    }
+)
+# Smallest share of the budget a file's diff is shown with; files that would
+# get less are listed with their --numstat counts instead.
+DIFF_MIN_FILE_CHARS = 400
+# Estimated diff chars per changed line, for sizing files from --numstat.
+DIFF_LINE_CHARS = 60
+# Files estimated at more than this many budgets get a git diff of their own,
+# stopped once their share is read, so they never hold up the other files.
+DIFF_OVERSIZE_FACTOR = 4
+# (path, lines added, lines deleted, old path) from --numstat; counts are None
+# for binary files and old path differs from path for renames and copies.
+FileStat = tuple[str, int | None, int | None, str]
+# Generated messages kept under .git, least recently used evicted first.
+CACHE_DIR_NAME = "commit-ai-cache"
+CACHE_MAX_ENTRIES = 64
+CACHE_MAX_BYTES = 1_000_000
+# How long the hook waits on a message `prewarm` is still generating.
+PREWARM_WAIT_SECONDS = 600
+PREWARM_POLL_SECONDS = 0.25
+PREWARM_WORKER_ARG = "--prewarm-worker"
+# COMMIT_AI_DEBUG log inside .git, rotated to <name>.1 past the size cap.
+DEBUG_LOG_NAME = "commit-ai.debug.log"
+DEBUG_LOG_MAX_BYTES = 1_000_000
 
 # Event type groups for clarity/readability.
 REASONING_EVENT_TYPES = {
@@ -72,6 +117,8 @@ REASONING_EVENT_TYPES = {
 REASONING_DONE_EVENT = "response.reasoning_summary_part.done"
 TERMINAL_EVENT_TYPES = {"response.completed", "response.error", "response.failed"}
 LIST_ITEM_RE = re.compile(r"^(?P<indent>[ \t]*)(?:[-*+]|\d+[.)])\s+")
+# Cap on reasoning panel repaints; each one re-renders the whole panel.
+REASONING_FPS = 12
 
 # Ensure Nix profile bins are on PATH for git hooks (e.g., 1Password `op`).
 _home = os.environ.get("HOME", "")
@@ -85,40 +132,320 @@ def debug_enabled() -> bool:
     return bool(os.environ.get("COMMIT_AI_DEBUG"))
 
 
-def _debug_log_path() -> Optional[str]:
+def _git_dir() -> Path | None:
     with suppress(Exception):
         cp = run(["git", "rev-parse", "--git-dir"])
         if cp.returncode == 0:
             git_dir = (cp.stdout or "").strip()
             if git_dir:
-                return str(Path(git_dir) / "commit-ai.debug.log")
+                return Path(git_dir)
     return None
 
 
+class DebugLog:
+    """Timestamped JSON lines appended to DEBUG_LOG_NAME inside .git.
+
+    The path is resolved and the file opened on first use. The handle is line
+    buffered, so each entry reaches the file as one O_APPEND write and lines
+    from the hook and a prewarm worker never interleave. Both may rotate the
+    file, so its size is read from the file itself and a writer whose file
+    was rotated away reopens the new one.
+    """
+
+    def __init__(self) -> None:
+        self._path: Path | None = None
+        self._file: IO[str] | None = None
+        self._opened = False
+        self._lock = threading.Lock()
+
+    def _open(self) -> IO[str] | None:
+        if not self._opened:
+            self._opened = True
+            git_dir = _git_dir()
+            if git_dir is not None:
+                self._path = git_dir / DEBUG_LOG_NAME
+                self._file = self._path.open("a", buffering=1, encoding="utf-8")
+                atexit.register(self.close)
+        return self._file
+
+    def _current(self) -> bool:
+        """Whether our handle is still the file at the log path."""
+        assert self._file is not None and self._path is not None
+        try:
+            return os.path.samestat(os.stat(self._path), os.fstat(self._file.fileno()))
+        except OSError:
+            return False
+
+    def _reopen(self) -> None:
+        assert self._file is not None and self._path is not None
+        self._file.close()
+        self._file = self._path.open("a", buffering=1, encoding="utf-8")
+
+    def _rotate(self) -> None:
+        assert self._file is not None and self._path is not None
+        # Closing the handle in _reopen releases the lock.
+        fcntl.flock(self._file.fileno(), fcntl.LOCK_EX)
+        if self._current():
+            os.replace(self._path, self._path.with_name(f"{DEBUG_LOG_NAME}.1"))
+        self._reopen()
+
+    def write(self, msg: str) -> None:
+        line = (
+            json.dumps(
+                {
+                    "ts": datetime.now(UTC).isoformat(timespec="milliseconds"),
+                    "pid": os.getpid(),
+                    "msg": msg,
+                }
+            )
+            + "\n"
+        )
+        with self._lock:
+            if self._open() is None:
+                return
+            assert self._file is not None
+            if not self._current():
+                self._reopen()
+            size = os.fstat(self._file.fileno()).st_size
+            if size and size + len(line.encode("utf-8")) > DEBUG_LOG_MAX_BYTES:
+                self._rotate()
+            self._file.write(line)
+
+    def close(self) -> None:
+        with self._lock:
+            if self._file is not None:
+                with suppress(OSError):
+                    self._file.close()
+                self._file = None
+
+
+DEBUG_LOG = DebugLog()
+
+
 def dbg(msg: str) -> None:
     if not debug_enabled():
         return
-    line = f"[DEBUG] {msg}\n"
     with suppress(Exception):
-        sys.stderr.write(line)
+        sys.stderr.write(f"[DEBUG] {msg}\n")
         sys.stderr.flush()
     # Mirror debug output to a log file inside .git for post-run inspection.
     with suppress(Exception):
-        log_path = _debug_log_path()
-        if log_path:
-            Path(log_path).write_text(
-                (
-                    Path(log_path).read_text(encoding="utf-8")
-                    if Path(log_path).exists()
-                    else ""
-                )
-                + line,
-                encoding="utf-8",
-            )
+        DEBUG_LOG.write(msg)
+
+
+def cache_key(model: str, effort: str, verbosity: str, prompt: str) -> str:
+    return hashlib.sha256(
+        json.dumps([model, effort, verbosity, prompt]).encode()
+    ).hexdigest()
+
+
+def _cache_dir() -> Path | None:
+    git_dir = _git_dir()
+    if git_dir is None:
+        return None
+    return git_dir / CACHE_DIR_NAME
+
+
+def cache_get(key: str) -> str:
+    """Return the cached message for key, or "" on a miss."""
+    cache_dir = _cache_dir()
+    if cache_dir is None:
+        return ""
+    path = cache_dir / f"{key}.txt"
+    with suppress(OSError):
+        message = path.read_text(encoding="utf-8")
+        # Mark as recently used for eviction.
+        os.utime(path)
+        return message
+    return ""
+
+
+def cache_put(key: str, message: str) -> None:
+    """Store message under key, then evict least recently used entries."""
+    cache_dir = _cache_dir()
+    if cache_dir is None:
+        return
+    with suppress(OSError):
+        cache_dir.mkdir(exist_ok=True)
+        tmp = cache_dir / f".{key}.{os.getpid()}.tmp"
+        tmp.write_text(message, encoding="utf-8")
+        os.replace(tmp, cache_dir / f"{key}.txt")
+
+        entries = []
+        for path in cache_dir.glob("*.txt"):
+            with suppress(OSError):
+                st = path.stat()
+                entries.append((st.st_mtime, st.st_size, path))
+        entries.sort(reverse=True)
+        total = 0
+        for n, (_, size, path) in enumerate(entries):
+            total += size
+            if n >= CACHE_MAX_ENTRIES or total > CACHE_MAX_BYTES:
+                with suppress(OSError):
+                    path.unlink()
+
+
+def _pending_path(key: str) -> Path | None:
+    cache_dir = _cache_dir()
+    if cache_dir is None:
+        return None
+    return cache_dir / f"{key}.pending"
+
+
+def _process_started(pid: int) -> str:
+    """An opaque start time for pid, to tell it from a later reuse of the pid;
+    "" if pid is not running."""
+    if os.path.exists("/proc/self/stat"):
+        with suppress(OSError, IndexError):
+            stat = Path(f"/proc/{pid}/stat").read_text(encoding="utf-8")
+            # Field 22, counted after the parenthesised command name.
+            return stat.rpartition(")")[2].split()[19]
+        return ""
+    with suppress(OSError):
+        return run(["ps", "-o", "lstart=", "-p", str(pid)]).stdout.strip()
+    return ""
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except PermissionError:
+        return True
+    except OSError:
+        return False
+    return True
+
+
+def _write_pending(pending: Path, pid: int) -> None:
+    """Atomically record pid and its start time as generating pending's key."""
+    entry = {"pid": pid, "started": _process_started(pid)}
+    tmp = pending.with_name(f".{pending.name}.{os.getpid()}.tmp")
+    tmp.write_text(json.dumps(entry), encoding="utf-8")
+    os.replace(tmp, pending)
+
+
+def _pending_pid(pending: Path) -> int | None:
+    """Return the live process recorded in pending, or None after removing a
+    stale file (dead process, or its pid since reused)."""
+    try:
+        entry = json.loads(pending.read_text(encoding="utf-8"))
+        pid = int(entry["pid"])
+        started = str(entry["started"])
+    except (OSError, ValueError, KeyError, TypeError):
+        pid, started = 0, ""
+    if started and _process_started(pid) == started:
+        return pid
+    with suppress(OSError):
+        pending.unlink()
+    return None
+
+
+def prewarm_running(key: str) -> bool:
+    """Return True while a background prewarm is generating key."""
+    pending = _pending_path(key)
+    return pending is not None and _pending_pid(pending) is not None
+
+
+def wait_for_prewarm(key: str) -> str:
+    """Attach to an in-flight prewarm for key; return its message or ""."""
+    # Resolved once: the path needs a git subprocess and the loop polls often.
+    pending = _pending_path(key)
+    pid = None if pending is None else _pending_pid(pending)
+    if pending is None or pid is None:
+        return ""
+    sys.stderr.write("commit-ai: waiting for background generation\n")
+    sys.stderr.flush()
+    deadline = time.monotonic() + PREWARM_WAIT_SECONDS
+    while time.monotonic() < deadline:
+        if not _pid_alive(pid):
+            # `git prewarm` hands the file over to its worker before exiting;
+            # re-read it, checking the start time again, only then.
+            pid = _pending_pid(pending)
+            if pid is None:
+                break
+        time.sleep(PREWARM_POLL_SECONDS)
+    return cache_get(key)
+
+
+def prewarm() -> int:
+    """Start generating the message for the current diff in the background.
+
+    The result lands in the cache under the same key the hook computes, so
+    the hook picks it up (or waits for it) as long as the diff is unchanged.
+    """
+    if run(["git", "rev-parse", "--is-inside-work-tree"]).returncode != 0:
+        return 0
+    diff = get_diff()
+    if not diff:
+        return 0
+    prompt = build_prompt(diff)
+    key = cache_key(MODEL, reasoning_effort(), TEXT_VERBOSITY, prompt)
+    pending = _pending_path(key)
+    if pending is None:
+        return 0
+    # Drop pending files left by workers that died, for any key.
+    for other in pending.parent.glob("*.pending"):
+        _pending_pid(other)
+    if cache_get(key) or prewarm_running(key):
+        dbg(f"prewarm {key[:12]}: already cached or running")
+        return 0
+    # The worker inherits the key through the environment.
+    if not ensure_api_key():
+        sys.stderr.write("commit-ai: OPENAI_API_KEY is not set; not prewarming\n")
+        return 0
+    try:
+        pending.parent.mkdir(exist_ok=True)
+        # Claim the key before spawning so a hook never sees it unclaimed.
+        _write_pending(pending, os.getpid())
+    except OSError as exc:
+        dbg(f"prewarm {key[:12]}: cannot write {pending}: {exc}")
+        return 0
+    proc = subprocess.Popen(
+        [sys.executable, os.path.abspath(__file__), PREWARM_WORKER_ARG],
+        stdin=subprocess.PIPE,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        start_new_session=True,
+        text=True,
+    )
+    with suppress(OSError):
+        _write_pending(pending, proc.pid)
+    assert proc.stdin is not None
+    proc.stdin.write(prompt)
+    proc.stdin.close()
+    sys.stderr.write(f"commit-ai: generating in the background ({key[:12]})\n")
+    return 0
+
+
+def prewarm_worker() -> int:
+    """Generate the message for the prompt on stdin and cache it."""
+    prompt = sys.stdin.read()
+    effort = reasoning_effort()
+    key = cache_key(MODEL, effort, TEXT_VERBOSITY, prompt)
+    try:
+        api_key = ensure_api_key()
+        if api_key:
+            output = call_responses_stream(API_BASE, MODEL, prompt, api_key, effort)
+            if output.strip():
+                cache_put(key, output)
+    finally:
+        pending = _pending_path(key)
+        if pending is not None:
+            with suppress(OSError):
+                pending.unlink()
+    return 0
+
+
+def reasoning_effort() -> str:
+    effort = (REASONING_EFFORT or "medium").lower()
+    if effort not in ("low", "medium", "high", "xhigh"):
+        effort = "medium"
+    return effort
 
 
 def usage() -> None:
-    sys.stderr.write(f"Usage: {os.path.basename(sys.argv[0])} <commit-msg-file>|-\n")
+    name = os.path.basename(sys.argv[0])
+    sys.stderr.write(f"Usage: {name} <commit-msg-file>|-\n       {name} prewarm\n")
 
 
 def ensure_api_key() -> str:
@@ -190,26 +517,228 @@ def run(args_or_cmd: Union[str, Sequence[str]]) -> subprocess.CompletedProcess[s
     )
 
 
-def get_diff() -> str:
-    """Return staged diff; if empty, fall back to working tree diff."""
+def diff_numstat(args: Sequence[str]) -> list[FileStat]:
+    """Return a FileStat per file changed in `git diff <args>`."""
+    fields = run(["git", "diff", "--numstat", "-z", *args]).stdout.split("\0")
+    files: list[FileStat] = []
+    i = 0
+    while i < len(fields) and fields[i]:
+        added, deleted, path = fields[i].split("\t", 2)
+        i += 1
+        old_path = path
+        if not path:
+            # Renames and copies list the old and new paths as extra fields.
+            old_path, path = fields[i], fields[i + 1]
+            i += 2
+        files.append(
+            (
+                path,
+                None if added == "-" else int(added),
+                None if deleted == "-" else int(deleted),
+                old_path,
+            )
+        )
+    return files
+
+
+def summarized_reasons(files: Sequence[FileStat]) -> dict[str, str]:
+    """Map paths that should only be summarized to why: lockfiles, binary and
+    files marked linguist-generated or -diff in .gitattributes."""
+    reasons: dict[str, str] = {}
+    for path, added, _, _ in files:
+        if added is None:
+            reasons[path] = "binary"
+        elif Path(path).name in LOCKFILE_NAMES:
+            reasons[path] = "lockfile"
+    cp = subprocess.run(
+        ["git", "check-attr", "-z", "--stdin", "linguist-generated", "diff"],
+        input="".join(f"{path}\0" for path, _, _, _ in files),
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+        text=True,
+        check=False,
+    )
+    out = cp.stdout.split("\0")
+    for path, attr, value in zip(out[0::3], out[1::3], out[2::3]):
+        if attr == "linguist-generated" and value in ("set", "true"):
+            reasons.setdefault(path, "generated")
+        elif attr == "diff" and value == "unset":
+            reasons.setdefault(path, "-diff")
+    return reasons
+
+
+def estimate_diff_chars(stat: FileStat) -> int:
+    path, added, deleted, _ = stat
+    return 200 + 2 * len(path) + ((added or 0) + (deleted or 0)) * DIFF_LINE_CHARS
+
+
+def summary_line(stat: FileStat, reason: str = "") -> str:
+    path, added, deleted, _ = stat
+    details = [reason] if reason else []
+    if added is not None:
+        details.append(f"+{added} -{deleted}")
+    return f"- {path} ({', '.join(details)})\n"
+
+
+def literal_pathspecs(files: Sequence[FileStat]) -> list[str]:
+    """Pathspecs matching exactly files, with both sides of renames."""
+    return [
+        f":(top,literal){name}"
+        for path, _, _, old_path in files
+        for name in dict.fromkeys((old_path, path))
+    ]
 
-    def diff_staged() -> str:
-        q = run(["git", "diff", "--staged", "--quiet"])  # 0 means no diff
-        if q.returncode == 0:
-            return ""
-        return run(
-            ["git", "-c", "core.safecrlf=false", "diff", "--staged", "--no-color"]
-        ).stdout
 
-    def diff_working() -> str:
-        q = run(["git", "diff", "--quiet"])  # 0 means no diff
-        if q.returncode == 0:
-            return ""
-        return run(["git", "-c", "core.safecrlf=false", "diff", "--no-color"]).stdout
+def split_diff(args: Sequence[str], cap: int, files: int) -> list[str]:
+    """Stream `git diff <args>` into one diff per file, each at most cap chars.
+
+    The rest of a long file is read and dropped rather than kept. git is
+    killed once the last of the expected files has filled its cap.
+    """
+    proc = subprocess.Popen(
+        ["git", "-c", "core.safecrlf=false", "diff", "--no-color", *args],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+        text=True,
+        errors="replace",
+    )
+    assert proc.stdout is not None
+    diffs: list[list[str]] = []
+    size = 0
+    at_line_start = True
+    try:
+        for line in iter(lambda: proc.stdout.readline(64 * 1024), ""):
+            if at_line_start and line.startswith("diff --git "):
+                diffs.append([])
+                size = 0
+            at_line_start = line.endswith("\n")
+            if diffs and size < cap:
+                diffs[-1].append(line[: cap - size])
+                size += len(diffs[-1][-1])
+            if len(diffs) >= files and size >= cap:
+                dbg("last file filled its share; stopping git early")
+                proc.kill()
+                break
+    except BaseException:
+        proc.kill()
+        raise
+    finally:
+        proc.stdout.close()
+        proc.wait()
+    return ["".join(parts) for parts in diffs]
+
+
+def fair_shares(sizes: Sequence[int], budget: int) -> list[int]:
+    """Split budget so small items get all they need and large ones share the rest."""
+    shares = [0] * len(sizes)
+    left = budget
+    order = sorted(range(len(sizes)), key=lambda i: sizes[i])
+    for n, i in enumerate(order):
+        shares[i] = min(sizes[i], left // (len(order) - n))
+        left -= shares[i]
+    return shares
+
+
+def truncate_diff(diff: str, share: int) -> str:
+    """Cut diff to about share chars at a line, always keeping the file header
+    through the first hunk header."""
+    if len(diff) <= share:
+        return diff
+    hunk = diff.find("\n@@")
+    header_end = diff.find("\n", hunk + 1) + 1 if hunk >= 0 else 0
+    kept = diff[: max(share, header_end)].rpartition("\n")[0]
+    return f"{kept}\n[... diff truncated]\n"
+
+
+def condense_diff(args: Sequence[str], files: Sequence[FileStat]) -> str:
+    """Fit the diff for files into DIFF_TOKEN_BUDGET, covering every file.
+
+    Lockfiles, binary and generated files become one-line summaries without
+    their diff being read. The smallest of the rest by --numstat are shown,
+    as many as can each get DIFF_MIN_FILE_CHARS, with a fair share of the
+    budget each; any left over are summarized with their counts.
+    """
+    budget = DIFF_TOKEN_BUDGET * CHARS_PER_TOKEN
+    reasons = summarized_reasons(files)
+    candidates = sorted(
+        (stat for stat in files if stat[0] not in reasons), key=estimate_diff_chars
+    )
+    needs = [min(estimate_diff_chars(stat), DIFF_MIN_FILE_CHARS) for stat in candidates]
+
+    header = "Summarized files (diff omitted):\n"
+    fixed = (
+        len(header)
+        + 1
+        + sum(
+            len(summary_line(stat, reasons[stat[0]]))
+            for stat in files
+            if stat[0] in reasons
+        )
+    )
+    shown = len(candidates)
+    listed = 0
+    need = sum(needs)
+    while shown and fixed + listed + need > budget:
+        shown -= 1
+        need -= needs[shown]
+        listed += len(summary_line(candidates[shown]))
+    shown_stats = candidates[:shown]
+
+    shown_paths = {stat[0] for stat in shown_stats}
+    lines = [
+        summary_line(stat, reasons.get(stat[0], ""))
+        for stat in files
+        if stat[0] not in shown_paths
+    ]
+    summary = ""
+    if lines:
+        # Even one line per file can overflow with thousands of files.
+        room = budget - len(header) - 1 - 64
+        kept = 0
+        for line in lines:
+            if room < len(line):
+                break
+            room -= len(line)
+            kept += 1
+        more = (
+            f"- ... and {len(lines) - kept} more files\n" if kept < len(lines) else ""
+        )
+        summary = header + "".join(lines[:kept]) + more + "\n"
+
+    diffs: list[str] = []
+    if shown_stats:
+        available = max(0, budget - len(summary))
+        # No file can get more than what the others leave at their minimum.
+        cap = available - need + DIFF_MIN_FILE_CHARS
+        large = [
+            stat
+            for stat in shown_stats
+            if estimate_diff_chars(stat) > DIFF_OVERSIZE_FACTOR * budget
+        ]
+        small = [stat for stat in shown_stats if stat not in large]
+        if small:
+            diffs = split_diff(
+                [*args, "--", *literal_pathspecs(small)], cap + 1, len(small)
+            )
+        shares = fair_shares(
+            [*map(len, diffs), *map(estimate_diff_chars, large)], available
+        )
+        for stat, share in zip(large, shares[len(diffs) :]):
+            diffs += split_diff(
+                [*args, "--", *literal_pathspecs([stat])], share + 1, 1
+            ) or [""]
+        diffs = [truncate_diff(diff, share) for diff, share in zip(diffs, shares)]
+    dbg(f"diff_files={len(files)} shown={len(shown_stats)} summarized={len(lines)}")
+    return summary + "".join(diffs)
+
 
-    # Prefer staged; if empty, fall back to working tree
-    d = diff_staged()
-    return d or diff_working()
+def get_diff() -> str:
+    """Return the staged diff, condensed; if nothing is staged, the working tree's."""
+    for args in (["--staged"], []):
+        files = diff_numstat(args)
+        if files:
+            return condense_diff(args, files)
+    return ""
 
 
 def has_meaningful_content(path: str) -> bool:
@@ -286,27 +815,118 @@ def format_api_error(body: str) -> str:
     return compact[:200] + (" …" if len(compact) > 200 else "")
 
 
-def format_reasoning_markdown(markdown: str) -> str:
-    """Add padded separators between top-level reasoning list items."""
-    lines = markdown.splitlines()
-    formatted: list[str] = []
-    seen_list_item = False
+class ReasoningMarkdown:
+    """Reasoning text with padded separators between top-level list items.
+
+    Deltas are only collected by append; render formats the lines completed
+    since the last render, so the cost per render is the new text plus the
+    trailing partial line rather than the whole buffer.
+    """
 
-    for line in lines:
+    def __init__(self) -> None:
+        self._deltas: list[str] = []
+        self._done = ""
+        self._last_line: str | None = None
+        self._partial = ""
+        self._seen_list_item = False
+
+    def append(self, text: str) -> None:
+        self._deltas.append(text)
+
+    def _format(self, line: str, seen_list_item: bool) -> tuple[list[str], bool]:
         match = LIST_ITEM_RE.match(line)
         is_top_level_item = bool(
             match and len(match.group("indent").expandtabs(4)) == 0
         )
+        formatted: list[str] = []
         if is_top_level_item and seen_list_item:
-            if formatted and formatted[-1].strip():
+            if self._last_line is not None and self._last_line.strip():
                 formatted.append("")
             formatted.extend(["---", ""])
         formatted.append(line)
-        if is_top_level_item:
-            seen_list_item = True
+        return formatted, seen_list_item or is_top_level_item
+
+    def render(self) -> str:
+        if self._deltas:
+            text = self._partial + "".join(self._deltas)
+            self._deltas.clear()
+            *complete, self._partial = text.split("\n")
+            for line in complete:
+                formatted, self._seen_list_item = self._format(
+                    line, self._seen_list_item
+                )
+                self._done += "".join(f"{f}\n" for f in formatted)
+                self._last_line = formatted[-1]
+        if not self._partial:
+            return self._done
+        formatted, _ = self._format(self._partial, self._seen_list_item)
+        return self._done + "\n".join(formatted)
+
+
+def format_reasoning_markdown(markdown: str) -> str:
+    """Add padded separators between top-level reasoning list items."""
+    formatter = ReasoningMarkdown()
+    formatter.append(markdown)
+    return formatter.render()
+
+
+class ReasoningPainter:
+    """Repaint a Rich Live reasoning panel from a background thread.
+
+    The SSE reader only appends deltas; at most REASONING_FPS times a second
+    the painter renders whatever arrived, so slow terminals (e.g. over SSH)
+    never hold up network reads.
+    """
+
+    def __init__(self, live, panel: Callable[[str], object]) -> None:
+        self._live = live
+        self._panel = panel
+        self._markdown = ReasoningMarkdown()
+        self._lock = threading.Lock()
+        self._dirty = False
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def append(self, text: str) -> None:
+        with self._lock:
+            self._markdown.append(text)
+            self._dirty = True
+
+    def _run(self) -> None:
+        while not self._stop.wait(1 / REASONING_FPS):
+            self._paint()
+
+    def _paint(self) -> None:
+        with self._lock:
+            if not self._dirty:
+                return
+            self._dirty = False
+            markdown = self._markdown.render()
+        self._live.update(self._panel(markdown), refresh=True)
+
+    def close(self) -> None:
+        """Stop the thread and paint anything still pending."""
+        self._stop.set()
+        self._thread.join()
+        self._paint()
+
+    def __enter__(self) -> Self:
+        return self
+
+    def __exit__(self, *exc) -> bool:
+        self.close()
+        return False
 
-    trailing_newline = "\n" if markdown.endswith("\n") else ""
-    return "\n".join(formatted) + trailing_newline
+
+class _NullContext:
+    """Stands in for Live and ReasoningPainter when Rich isn't installed."""
+
+    def __enter__(self):
+        return None
+
+    def __exit__(self, *exc):
+        return False
 
 
 def call_responses_stream(
@@ -340,7 +960,8 @@ def call_responses_stream(
     def do_stream(payload: dict) -> str:
         parts: list[str] = []
         seen_reasoning = False
-        reason_buffer: str = ""
+        # Last two chars of reasoning shown, to end on a blank line.
+        reason_tail = ""
 
         with http_request(url, payload, headers) as resp:
             if HAVE_RICH:
@@ -357,10 +978,7 @@ def call_responses_stream(
                     if not HAVE_RICH:
                         return md  # unused without Rich
                     return Panel(
-                        Markdown(
-                            format_reasoning_markdown(md),
-                            code_theme="github-dark",
-                        ),
+                        Markdown(md, code_theme="github-dark"),
                         border_style="grey37",
                         title="reasoning",
                         title_align="left",
@@ -376,17 +994,24 @@ def call_responses_stream(
                         vertical_overflow="visible",
                     )
                 else:
-
-                    class _NullLive:
-                        def __enter__(self):
-                            return None
-
-                        def __exit__(self, *exc):
-                            return False
-
-                    live_ctx = _NullLive()
-
-                with live_ctx as live:
+                    live_ctx = _NullContext()
+
+                def show(text: str) -> None:
+                    nonlocal reason_tail
+                    reason_tail = (reason_tail + text)[-2:]
+                    if painter is not None:
+                        painter.append(text)
+                    else:
+                        # Stream plain text to stderr as it arrives
+                        sys.stderr.write(text)
+                        sys.stderr.flush()
+
+                with (
+                    live_ctx as live,
+                    (
+                        ReasoningPainter(live, _panel) if HAVE_RICH else _NullContext()
+                    ) as painter,
+                ):
                     for raw in resp:
                         try:
                             line = raw.decode("utf-8", errors="ignore").strip()
@@ -436,13 +1061,7 @@ def call_responses_stream(
                             if (not reason_text) and obj.get("error"):
                                 reason_text = obj["error"].get("message", "")
                             if reason_text:
-                                reason_buffer += reason_text
-                                if HAVE_RICH:
-                                    live.update(_panel(reason_buffer), refresh=True)
-                                else:
-                                    # Stream plain text to stderr as it arrives
-                                    sys.stderr.write(reason_text)
-                                    sys.stderr.flush()
+                                show(reason_text)
                                 seen_reasoning = True
                         elif etype in {"error", "response.error", "response.failed"}:
                             # Surface API errors explicitly so the user sees them.
@@ -454,31 +1073,15 @@ def call_responses_stream(
                                 emsg = f"{code}: {msg}" if code else msg
                             else:
                                 emsg = obj.get("message", "") or "unknown error"
-                            line = f"commit-ai: API error: {emsg}\n"
-                            if HAVE_RICH:
-                                reason_buffer += line
-                                live.update(_panel(reason_buffer), refresh=True)
-                            else:
-                                sys.stderr.write(line)
-                                sys.stderr.flush()
+                            show(f"commit-ai: API error: {emsg}\n")
                         # Mark that we want two blank lines after reasoning output.
                         if etype == REASONING_DONE_EVENT and seen_reasoning:
-                            reason_buffer += "\n\n"
-                            if HAVE_RICH:
-                                live.update(_panel(reason_buffer), refresh=True)
-                            else:
-                                sys.stderr.write("\n\n")
-                                sys.stderr.flush()
+                            show("\n\n")
 
                         if etype in TERMINAL_EVENT_TYPES and seen_reasoning:
                             # Ensure we end on a blank line.
-                            if not reason_buffer.endswith("\n\n"):
-                                reason_buffer += "\n\n"
-                                if HAVE_RICH:
-                                    live.update(_panel(reason_buffer), refresh=True)
-                                else:
-                                    sys.stderr.write("\n\n")
-                                    sys.stderr.flush()
+                            if reason_tail != "\n\n":
+                                show("\n\n")
             finally:
                 pass
         return "".join(parts).strip()
@@ -507,6 +1110,10 @@ def main() -> int:
         usage()
         return 0
     target = sys.argv[1]
+    if target == "prewarm":
+        return prewarm()
+    if target == PREWARM_WORKER_ARG:
+        return prewarm_worker()
     source = sys.argv[2] if len(sys.argv) >= 3 else ""
     sha1 = sys.argv[3] if len(sys.argv) >= 4 else ""
     write_to_file = target != "-"
@@ -524,13 +1131,6 @@ def main() -> int:
         dbg("not a git repo; exiting")
         return 0
 
-    api_key = ensure_api_key()
-    if not api_key:
-        sys.stderr.write("commit-ai: no OPENAI_API_KEY; skipping\n")
-        sys.stderr.flush()
-        dbg("missing OPENAI_API_KEY")
-        return 0
-
     # Skip if commit message already has meaningful content.
     # Ignore trailers like Signed-off-by when using -s.
     if write_to_file and has_meaningful_content(target):
@@ -545,26 +1145,46 @@ def main() -> int:
         sys.stderr.flush()
         dbg("no diff returned")
         return 0
-    diff_trunc = diff[:DIFF_MAX_CHARS]
-    dbg(f"diff_chars={len(diff_trunc)}")
-    prompt = build_prompt(diff_trunc)
+    dbg(f"diff_chars={len(diff)} est_tokens={len(diff) // CHARS_PER_TOKEN}")
+    prompt = build_prompt(diff)
 
     dbg(f"model={MODEL} base={API_BASE}")
 
     output = ""
-    effort = (REASONING_EFFORT or "medium").lower()
-    if effort not in ("low", "medium", "high", "xhigh"):
-        effort = "medium"
-
-    # Stream only reasoning to stderr; do not echo the final commit text.
-    output = call_responses_stream(
-        API_BASE,
-        MODEL,
-        prompt,
-        api_key,
-        effort,
-    )
-    dbg(f"stream_bytes={len(output)}")
+    effort = reasoning_effort()
+
+    # Identical prompts (re-runs, aborted editors, --amend) reuse the last
+    # message, or the one a `prewarm` is still generating for this diff;
+    # COMMIT_AI_REFRESH=1 forces a new one.
+    key = cache_key(MODEL, effort, TEXT_VERBOSITY, prompt)
+    if os.environ.get("COMMIT_AI_REFRESH"):
+        dbg("COMMIT_AI_REFRESH set; ignoring cached message")
+    else:
+        output = cache_get(key) or wait_for_prewarm(key)
+    if output:
+        sys.stderr.write("commit-ai: reusing cached message for identical diff\n")
+        sys.stderr.flush()
+        dbg(f"cache hit {key[:12]}")
+    else:
+        # Only needed on a cache miss; 1Password lookups are slow.
+        api_key = ensure_api_key()
+        if not api_key:
+            sys.stderr.write("commit-ai: no OPENAI_API_KEY; skipping\n")
+            sys.stderr.flush()
+            dbg("missing OPENAI_API_KEY")
+            return 0
+
+        # Stream only reasoning to stderr; do not echo the final commit text.
+        output = call_responses_stream(
+            API_BASE,
+            MODEL,
+            prompt,
+            api_key,
+            effort,
+        )
+        dbg(f"stream_bytes={len(output)}")
+        if output.strip():
+            cache_put(key, output)
 
     if output:
         if write_to_file:
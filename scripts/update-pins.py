@@ -1,57 +1,950 @@
 #!/usr/bin/env python3
 import argparse
+import base64
+import contextvars
+import hashlib
+import heapq
+import http.client
+import io
 import json
+import os
+import random
 import re
 import subprocess
 import sys
+import tarfile
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from collections.abc import Callable, Container, Iterable, Iterator, Sequence
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from functools import partial
 from pathlib import Path
-from shutil import which
-from typing import Iterable, Sequence
+from shutil import copytree, ignore_patterns, which
+from typing import IO
+from urllib.parse import urljoin, urlsplit
 from urllib.request import urlopen
 
 REPO_ROOT = Path(__file__).resolve().parents[1]
 FLAKE_PATH = REPO_ROOT / "flake.nix"
+FLAKE_LOCK_PATH = REPO_ROOT / "flake.lock"
 HOMEBRIDGE_PATH = REPO_ROOT / "pkgs" / "homebridge.nix"
 MOLE_PATH = REPO_ROOT / "pkgs" / "mole.nix"
 RAMP_CLI_PATH = REPO_ROOT / "pkgs" / "ramp-cli.nix"
 SCRYPTED_PATH = REPO_ROOT / "pkgs" / "scrypted.nix"
+PKGS_DIR = REPO_ROOT / "pkgs"
+# Tarballs with the hashes nix reported for them, for --verify-hasher.
+HASHER_FIXTURES_DIR = REPO_ROOT / "scripts" / "fixtures" / "archive-sri"
+HASHER_FIXTURES_PATH = HASHER_FIXTURES_DIR / "hashes.json"
+# Flakes this repo takes as inputs. They are updated and pushed before this
+# repo's own flake.lock so it locks their new heads.
+SIBLING_FLAKES = (REPO_ROOT.parent / "dotfiles", REPO_ROOT.parent / "vim")
+FLAKE_UPDATE_MESSAGE = "chore: nix flake update"
+CACHE_DIR = (
+    Path(os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache")
+    / "global-nix"
+    / "update-pins"
+)
 
 FAKE_SRI = "sha256-AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA="
+# What the npmDeps fallback build evaluates, copied into a private workspace.
+# The flake files are snapshotted before any target runs so the copy never
+# sees flake.nix and flake.lock out of step while codex is being updated.
+STAGED_FILES = ("flake.nix", "flake.lock")
+STAGED_DIRS = ("pkgs",)
+
+# --check exit codes.
+CHECK_CURRENT = 0
+CHECK_OUTDATED = 1
+CHECK_FAILED = 2
+
+# Concurrency and per-target wall-clock limits for the executor in main().
+DEFAULT_JOBS = 4
+DEFAULT_TIMEOUT = 900.0
+# Downloads are shared across targets, so cap them globally rather than per batch.
+PREFETCH_JOBS = 6
+HTTP_TIMEOUT = 60.0
+# Attempts after the first for connection errors and 429/5xx, with
+# exponential backoff starting at HTTP_BACKOFF seconds.
+HTTP_RETRIES = 3
+HTTP_BACKOFF = 0.5
+HTTP_RETRY_STATUSES = frozenset({429, 500, 502, 503, 504})
+HTTP_MAX_REDIRECTS = 5
+USER_AGENT = "global-nix-update-pins"
+# npm's abbreviated ("corgi") packument: dist-tags and slim version entries.
+NPM_ABBREVIATED = "application/vnd.npm.install-v1+json"
+# Parallel tarball downloads when hashing npm dependencies directly.
+NPM_FETCH_JOBS = 16
+# Prefetch cache limits; entries are tiny, so the count is the size bound.
+PREFETCH_CACHE_MAX_ENTRIES = 512
+PREFETCH_CACHE_MAX_AGE = 90 * 24 * 60 * 60
+# Tags move, so lookups are only reused for a short while.
+TAG_CACHE_TTL = 15 * 60
+# watch: how often to poll an upstream unless its PinSpec says otherwise,
+# the first retry delay after a failure (doubling up to the poll interval),
+# and the +/- fraction of jitter applied to every delay.
+DEFAULT_POLL_INTERVAL = 60 * 60
+WATCH_RETRY = 60
+WATCH_JITTER = 0.1
+# Unfinished targets older than this start over instead of resuming.
+JOURNAL_MAX_AGE = 24 * 60 * 60
+
+# Tag archives and release assets are addressed by tag, so their hash is stable.
+IMMUTABLE_URL_RE = re.compile(
+    r"^https://github\.com/[^/]+/[^/]+/"
+    r"(?:archive/refs/tags/[^/]+|releases/download/[^/]+/[^/]+)$"
+)
+
+# Absolute monotonic deadline for the target running in the current context.
+_deadline: contextvars.ContextVar[float | None] = contextvars.ContextVar(
+    "deadline", default=None
+)
+# Target(s) the current step works for, attached to trace spans.
+_target: contextvars.ContextVar[str | None] = contextvars.ContextVar(
+    "target", default=None
+)
+_prefetch_slots = threading.BoundedSemaphore(PREFETCH_JOBS)
+
+
+# Read once up front: os.umask can only be queried by setting it, which is
+# not safe once worker threads are creating files.
+_UMASK = os.umask(0)
+os.umask(_UMASK)
 
 
 class UpdateError(RuntimeError):
     pass
 
 
-def run(cmd: Sequence[str], check: bool = True) -> subprocess.CompletedProcess[str]:
-    return subprocess.run(
-        cmd,
-        check=check,
-        text=True,
-        capture_output=True,
-    )
+class HttpError(UpdateError):
+    def __init__(self, message: str, status: int | None = None) -> None:
+        super().__init__(message)
+        self.status = status
 
 
-def replace_one(pattern: str, repl: str, text: str, label: str) -> str:
-    updated, count = re.subn(pattern, repl, text, flags=re.M)
-    if count != 1:
-        raise UpdateError(f"Expected 1 match for {label}, found {count}.")
-    return updated
+class UnsupportedArchive(UpdateError):
+    """The archive needs nix to unpack, so fall back to nix prefetch."""
 
 
-def get_tags(repo_url: str) -> list[str]:
-    result = run(["git", "ls-remote", "--tags", "--refs", repo_url])
-    tags: list[str] = []
-    for line in result.stdout.splitlines():
-        parts = line.split("\t")
-        if len(parts) != 2:
+class UnsupportedLockfile(UpdateError):
+    """The lockfile needs nixpkgs' own fetcher, so fall back to a nix build."""
+
+
+class HashMismatch(UpdateError):
+    """A nix-free hasher disagreed with the hash nix computed."""
+
+
+def write_atomic(path: Path, text: str) -> None:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}.")
+    try:
+        # mkstemp creates 0600; keep the target's mode, or the umask default.
+        try:
+            mode = path.stat().st_mode & 0o777
+        except FileNotFoundError:
+            mode = 0o666 & ~_UMASK
+        os.chmod(fd, mode)
+        with os.fdopen(fd, "w", encoding="utf-8") as handle:
+            handle.write(text)
+        os.replace(tmp, path)
+    except BaseException:
+        Path(tmp).unlink(missing_ok=True)
+        raise
+
+
+class JsonStore:
+    """Keyed JSON entries in one file, loaded lazily and saved atomically.
+
+    mode is "use", "off" (bypass), or "verify" (recompute and compare);
+    subclasses decide what each mode means for their entries.
+    """
+
+    def __init__(self, path: Path) -> None:
+        self.path = path
+        self.mode = "use"
+        self._lock = threading.Lock()
+        self._entries: dict[str, dict[str, object]] | None = None
+        self._dirty = False
+
+    def _load(self) -> dict[str, dict[str, object]]:
+        if self._entries is None:
+            try:
+                data = json.loads(self.path.read_text(encoding="utf-8"))
+            except (OSError, ValueError):
+                data = {}
+            self._entries = data if isinstance(data, dict) else {}
+        return self._entries
+
+    def save(self) -> None:
+        with self._lock:
+            if not self._dirty or self._entries is None:
+                return
+            try:
+                write_atomic(
+                    self.path, json.dumps(self._entries, indent=2, sort_keys=True)
+                )
+            except OSError as exc:
+                print(f"warning: could not write {self.path}: {exc}", file=sys.stderr)
+            self._dirty = False
+
+
+class PrefetchCache(JsonStore):
+    """On-disk URL -> SRI map for immutable archives.
+
+    Entries are keyed by URL, unpack mode and stripRoot, evicted least recently used
+    first once there are more than max_entries, and dropped after max_age
+    seconds.
+    """
+
+    def __init__(self, path: Path, max_entries: int, max_age: float) -> None:
+        super().__init__(path)
+        self.max_entries = max_entries
+        self.max_age = max_age
+
+    @staticmethod
+    def _key(url: str, unpack: bool, strip_root: bool) -> str:
+        if not unpack:
+            return f"flat:{url}"
+        return f"{'unpack' if strip_root else 'unpack-nostrip'}:{url}"
+
+    def cacheable(self, url: str) -> bool:
+        return self.mode != "off" and bool(IMMUTABLE_URL_RE.match(url))
+
+    def get(self, url: str, unpack: bool, strip_root: bool = True) -> str | None:
+        if not self.cacheable(url):
+            return None
+        with self._lock:
+            entry = self._load().get(self._key(url, unpack, strip_root))
+            if not entry or time.time() - float(entry["created"]) > self.max_age:
+                return None
+            entry["used"] = time.time()
+            self._dirty = True
+            return str(entry["hash"])
+
+    def put(self, url: str, unpack: bool, sri: str, strip_root: bool = True) -> None:
+        if not self.cacheable(url):
+            return
+        with self._lock:
+            entries = self._load()
+            now = time.time()
+            entries[self._key(url, unpack, strip_root)] = {
+                "hash": sri,
+                "created": now,
+                "used": now,
+            }
+            self._evict(entries, now)
+            self._dirty = True
+        self.save()
+
+    def _evict(self, entries: dict[str, dict[str, object]], now: float) -> None:
+        for key in [
+            key
+            for key, entry in entries.items()
+            if now - float(entry["created"]) > self.max_age
+        ]:
+            del entries[key]
+        excess = len(entries) - self.max_entries
+        if excess > 0:
+            oldest = sorted(entries, key=lambda key: float(entries[key]["used"]))
+            for key in oldest[:excess]:
+                del entries[key]
+
+
+class TagCache(JsonStore):
+    """On-disk (repo, ref prefixes) -> tag list map that expires after ttl.
+
+    In "refresh" mode lookups always miss but results are still stored.
+    """
+
+    def __init__(self, path: Path, ttl: float) -> None:
+        super().__init__(path)
+        self.ttl = ttl
+
+    @staticmethod
+    def _key(repo_url: str, prefixes: Sequence[str]) -> str:
+        return " ".join([repo_url, *prefixes])
+
+    def get(self, repo_url: str, prefixes: Sequence[str]) -> list[str] | None:
+        if self.mode in ("off", "refresh"):
+            return None
+        with self._lock:
+            entry = self._load().get(self._key(repo_url, prefixes))
+            if not entry or time.time() - float(entry["fetched"]) > self.ttl:
+                return None
+            return [str(tag) for tag in entry["tags"]]
+
+    def put(self, repo_url: str, prefixes: Sequence[str], tags: list[str]) -> None:
+        if self.mode == "off":
+            return
+        with self._lock:
+            entries = self._load()
+            now = time.time()
+            entries[self._key(repo_url, prefixes)] = {"tags": tags, "fetched": now}
+            for key in [
+                key
+                for key, entry in entries.items()
+                if now - float(entry["fetched"]) > self.ttl
+            ]:
+                del entries[key]
+            self._dirty = True
+        self.save()
+
+
+class StepJournal(JsonStore):
+    """On-disk record of each target's finished steps, so a failed run resumes.
+
+    An entry holds the value pinned when the target started ("from"), the
+    resolved tag and version, the fields computed so far and the steps that
+    are done. It is dropped once the target is fully written.
+    """
+
+    def __init__(self, path: Path, max_age: float) -> None:
+        super().__init__(path)
+        self.max_age = max_age
+
+    def get(self, target: str) -> dict[str, object] | None:
+        if self.mode == "off":
+            return None
+        with self._lock:
+            entry = self._load().get(target)
+            if not entry or time.time() - float(entry["started"]) > self.max_age:
+                return None
+            return dict(entry)
+
+    def start(
+        self, target: str, pinned: str, tag: str, version: str, values: dict[str, str]
+    ) -> None:
+        self._update(
+            target,
+            {
+                "from": pinned,
+                "tag": tag,
+                "version": version,
+                "values": dict(values),
+                "done": ["resolve"],
+                "started": time.time(),
+            },
+        )
+
+    def record(self, target: str, step: str, values: dict[str, str]) -> None:
+        with self._lock:
+            entry = self._load().get(target)
+            if entry is None:
+                return
+            entry["values"] = dict(values)
+            entry["done"] = [*entry["done"], step]
+            self._dirty = True
+        self.save()
+
+    def finish(self, target: str) -> None:
+        self._update(target, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._load().clear()
+            self._dirty = True
+        self.save()
+
+    def _update(self, target: str, entry: dict[str, object] | None) -> None:
+        if self.mode == "off":
+            return
+        with self._lock:
+            entries = self._load()
+            if entry is None:
+                if entries.pop(target, None) is None:
+                    return
+            else:
+                entries[target] = entry
+            self._dirty = True
+        self.save()
+
+
+PREFETCH_CACHE = PrefetchCache(
+    CACHE_DIR / "prefetch.json",
+    max_entries=PREFETCH_CACHE_MAX_ENTRIES,
+    max_age=PREFETCH_CACHE_MAX_AGE,
+)
+TAG_CACHE = TagCache(CACHE_DIR / "tags.json", ttl=TAG_CACHE_TTL)
+
+
+class ETagCache(JsonStore):
+    """On-disk URL -> (ETag, body) map for conditional JSON requests."""
+
+    @staticmethod
+    def _key(url: str, accept: str) -> str:
+        return f"{accept} {url}" if accept else url
+
+    def get(self, url: str, accept: str) -> tuple[str, str] | None:
+        if self.mode == "off":
+            return None
+        with self._lock:
+            entry = self._load().get(self._key(url, accept))
+            if not entry:
+                return None
+            return str(entry["etag"]), str(entry["body"])
+
+    def put(self, url: str, accept: str, etag: str, body: str) -> None:
+        if self.mode == "off":
+            return
+        with self._lock:
+            self._load()[self._key(url, accept)] = {
+                "etag": etag,
+                "body": body,
+                "fetched": time.time(),
+            }
+            self._dirty = True
+        self.save()
+
+
+class LockCache(JsonStore):
+    """On-disk (git URL, rev) -> locked flake input attributes.
+
+    A commit's lock attributes never change, so entries do not expire.
+    mode "verify" also cross-checks freshly written locks with nix.
+    """
+
+    def get(self, url: str, rev: str) -> dict[str, object] | None:
+        if self.mode == "off":
+            return None
+        with self._lock:
+            entry = self._load().get(f"{url} {rev}")
+            return dict(entry) if entry else None
+
+    def put(self, url: str, rev: str, locked: dict[str, object]) -> None:
+        if self.mode == "off":
+            return
+        with self._lock:
+            self._load()[f"{url} {rev}"] = dict(locked)
+            self._dirty = True
+        self.save()
+
+
+class NpmShapeCache(JsonStore):
+    """On-disk lockfile shape -> whether npm_deps_hash matched fetchNpmDeps.
+
+    A shape is only trusted once nix has confirmed a hash for it; one that
+    ever mismatched stays untrusted, so its targets always use the nix build.
+    """
+
+    def trusted(self, shape: str) -> bool:
+        if self.mode == "off":
+            return False
+        with self._lock:
+            entry = self._load().get(shape)
+            return bool(entry and entry["ok"])
+
+    def put(self, shape: str, ok: bool) -> None:
+        if self.mode == "off":
+            return
+        with self._lock:
+            entries = self._load()
+            entry = entries.get(shape)
+            entries[shape] = {"ok": ok and (entry is None or bool(entry["ok"]))}
+            self._dirty = True
+        self.save()
+
+
+ETAG_CACHE = ETagCache(CACHE_DIR / "etags.json")
+LOCK_CACHE = LockCache(CACHE_DIR / "locks.json")
+NPM_SHAPES = NpmShapeCache(CACHE_DIR / "npm-shapes.json")
+JOURNAL = StepJournal(CACHE_DIR / "journal.json", max_age=JOURNAL_MAX_AGE)
+
+
+@dataclass(frozen=True)
+class Span:
+    phase: str
+    name: str
+    # Seconds since the tracer started.
+    start: float
+    duration: float
+    thread: int
+    thread_name: str
+    target: str | None
+
+
+class Tracer:
+    """Records a timed span around each subprocess, HTTP call and step.
+
+    Phases nest (a step wraps its prefetch, which wraps its nix call), so
+    per-phase totals overlap; the Chrome trace shows how they line up.
+    """
+
+    def __init__(self) -> None:
+        self.origin = time.perf_counter()
+        self.spans: list[Span] = []
+        self._lock = threading.Lock()
+
+    def clear(self) -> None:
+        with self._lock:
+            self.spans.clear()
+
+    @contextmanager
+    def span(self, phase: str, name: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            end = time.perf_counter()
+            thread = threading.current_thread()
+            record = Span(
+                phase,
+                name,
+                start - self.origin,
+                end - start,
+                thread.ident or 0,
+                thread.name,
+                _target.get(),
+            )
+            with self._lock:
+                self.spans.append(record)
+
+    def summary(self) -> str:
+        totals: dict[str, list[float]] = defaultdict(list)
+        with self._lock:
+            for record in self.spans:
+                totals[record.phase].append(record.duration)
+        lines = [f"  {'phase':<15} {'calls':>5} {'total':>8} {'max':>8}"]
+        for phase, durations in sorted(totals.items(), key=lambda kv: -sum(kv[1])):
+            lines.append(
+                f"  {phase:<15} {len(durations):>5} "
+                f"{sum(durations):7.1f}s {max(durations):7.1f}s"
+            )
+        return "\n".join(lines)
+
+    def write_chrome_trace(self, path: Path) -> None:
+        """Write the spans as Chrome trace-event JSON (chrome://tracing, Perfetto)."""
+        with self._lock:
+            spans = list(self.spans)
+        events: list[dict[str, object]] = []
+        threads = {record.thread: record.thread_name for record in spans}
+        for thread, name in threads.items():
+            events.append(
+                {
+                    "ph": "M",
+                    "name": "thread_name",
+                    "pid": 1,
+                    "tid": thread,
+                    "args": {"name": name},
+                }
+            )
+        for record in sorted(spans, key=lambda record: record.start):
+            args = {"target": record.target} if record.target else {}
+            events.append(
+                {
+                    "ph": "X",
+                    "cat": record.phase,
+                    "name": record.name,
+                    "pid": 1,
+                    "tid": record.thread,
+                    "ts": round(record.start * 1e6),
+                    "dur": round(record.duration * 1e6),
+                    "args": args,
+                }
+            )
+        write_atomic(path, json.dumps({"traceEvents": events}))
+
+
+TRACER = Tracer()
+
+
+def remaining_time() -> float | None:
+    deadline = _deadline.get()
+    if deadline is None:
+        return None
+    remaining = deadline - time.monotonic()
+    if remaining <= 0:
+        raise UpdateError("timed out")
+    return remaining
+
+
+def run(
+    cmd: Sequence[str], check: bool = True, cwd: Path | None = None
+) -> subprocess.CompletedProcess[str]:
+    try:
+        with TRACER.span("exec", " ".join(cmd[:3])):
+            result = subprocess.run(
+                cmd,
+                text=True,
+                capture_output=True,
+                cwd=cwd,
+                timeout=remaining_time(),
+                check=False,
+            )
+    except subprocess.TimeoutExpired as exc:
+        raise UpdateError(f"timed out running {' '.join(cmd)}") from exc
+    except FileNotFoundError as exc:
+        raise UpdateError(f"{cmd[0]} is not installed") from exc
+    if check and result.returncode != 0:
+        detail = result.stderr.strip().splitlines()[-1:] or [""]
+        raise UpdateError(
+            f"{' '.join(cmd)} exited with {result.returncode}: {detail[0]}".rstrip(": ")
+        )
+    return result
+
+
+def stream_lines(cmd: Sequence[str]) -> Iterator[str]:
+    """Yield a command's stdout lines as they arrive, honouring the deadline."""
+    with TRACER.span("exec", " ".join(cmd[:3])):
+        yield from _stream_lines(cmd)
+
+
+def _stream_lines(cmd: Sequence[str]) -> Iterator[str]:
+    try:
+        proc = subprocess.Popen(
+            cmd,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            text=True,
+        )
+    except FileNotFoundError as exc:
+        raise UpdateError(f"{cmd[0]} is not installed") from exc
+    timer = None
+    timeout = remaining_time()
+    if timeout is not None:
+        timer = threading.Timer(timeout, proc.kill)
+        timer.daemon = True
+        timer.start()
+    try:
+        assert proc.stdout is not None
+        yield from proc.stdout
+        stderr = proc.stderr.read() if proc.stderr else ""
+        returncode = proc.wait()
+    finally:
+        if timer is not None:
+            timer.cancel()
+        if proc.poll() is None:
+            proc.kill()
+            proc.wait()
+    if returncode < 0:
+        raise UpdateError(f"timed out running {' '.join(cmd)}")
+    if returncode != 0:
+        detail = stderr.strip().splitlines()[-1:] or [""]
+        raise UpdateError(
+            f"{' '.join(cmd)} exited with {returncode}: {detail[0]}".rstrip(": ")
+        )
+
+
+@dataclass(frozen=True)
+class HttpResponse:
+    status: int
+    # Lower-cased header names.
+    headers: dict[str, str]
+    body: bytes
+    # For HttpClient.stream, the unread body (instead of body) and a callback
+    # that closes it or returns its connection to the pool.
+    stream: IO[bytes] | None = None
+    release: Callable[[], None] | None = None
+
+
+class HttpClient:
+    """Keep-alive HTTP(S) connections pooled per host, with retries.
+
+    Each request's timeout is the smaller of HTTP_TIMEOUT and the current
+    target's remaining time. Non-HTTP URLs (file://) go through urlopen.
+    """
+
+    def __init__(self, max_idle: int) -> None:
+        self.max_idle = max_idle
+        self._idle: dict[tuple[str, str], list[http.client.HTTPConnection]] = (
+            defaultdict(list)
+        )
+        self._lock = threading.Lock()
+
+    def _checkout(
+        self, scheme: str, host: str, timeout: float, fresh: bool
+    ) -> tuple[http.client.HTTPConnection, bool]:
+        conn = None
+        if not fresh:
+            with self._lock:
+                idle = self._idle[(scheme, host)]
+                conn = idle.pop() if idle else None
+        if conn is not None:
+            conn.timeout = timeout
+            if conn.sock is not None:
+                conn.sock.settimeout(timeout)
+            return conn, True
+        if scheme == "https":
+            return http.client.HTTPSConnection(host, timeout=timeout), False
+        return http.client.HTTPConnection(host, timeout=timeout), False
+
+    def _checkin(
+        self, scheme: str, host: str, conn: http.client.HTTPConnection
+    ) -> None:
+        with self._lock:
+            idle = self._idle[(scheme, host)]
+            if len(idle) < self.max_idle:
+                idle.append(conn)
+                return
+        conn.close()
+
+    def request(
+        self,
+        url: str,
+        method: str = "GET",
+        body: bytes | None = None,
+        headers: dict[str, str] | None = None,
+        stream: bool = False,
+    ) -> HttpResponse:
+        """Send one request, following redirects; raise HttpError on failure.
+
+        304 is returned to the caller; other 4xx/5xx statuses raise. With
+        stream, a 2xx body is left unread for the caller; use self.stream.
+        """
+        with TRACER.span("http", f"{method} {url}"):
+            for _ in range(HTTP_MAX_REDIRECTS + 1):
+                response = self._send(url, method, body, headers or {}, stream)
+                location = response.headers.get("location")
+                if response.status in (301, 302, 303, 307, 308) and location:
+                    url = urljoin(url, location)
+                    if response.status == 303:
+                        method, body = "GET", None
+                    continue
+                if response.status >= 400:
+                    raise HttpError(
+                        f"{method} {url} returned HTTP {response.status}",
+                        response.status,
+                    )
+                return response
+        raise HttpError(f"{method} {url} redirected too many times")
+
+    @contextmanager
+    def stream(
+        self,
+        url: str,
+        method: str = "GET",
+        body: bytes | None = None,
+        headers: dict[str, str] | None = None,
+    ) -> Iterator[IO[bytes]]:
+        """Like request, but yield the body as a file object as it arrives.
+
+        Only getting the response headers is retried; errors while reading
+        the body are the caller's.
+        """
+        response = self.request(url, method, body, headers, stream=True)
+        if response.stream is None:
+            yield io.BytesIO(response.body)
+            return
+        try:
+            yield response.stream
+        finally:
+            assert response.release is not None
+            response.release()
+
+    def _send(
+        self,
+        url: str,
+        method: str,
+        body: bytes | None,
+        headers: dict[str, str],
+        stream: bool = False,
+    ) -> HttpResponse:
+        parts = urlsplit(url)
+        if parts.scheme not in ("http", "https"):
+            resp = urlopen(url, timeout=self._timeout())
+            if stream:
+                return HttpResponse(200, {}, b"", resp, resp.close)
+            with resp:
+                return HttpResponse(200, {}, resp.read())
+        target = parts.path or "/"
+        if parts.query:
+            target += f"?{parts.query}"
+        headers = {"User-Agent": USER_AGENT, **headers}
+
+        error = ""
+        for attempt in range(HTTP_RETRIES + 1):
+            if attempt:
+                delay = HTTP_BACKOFF * 2 ** (attempt - 1)
+                remaining = remaining_time()
+                if remaining is not None and remaining <= delay:
+                    break
+                time.sleep(delay)
+            try:
+                response = self._exchange(
+                    parts.scheme, parts.netloc, method, target, body, headers, stream
+                )
+            except (OSError, http.client.HTTPException) as exc:
+                error = str(exc) or type(exc).__name__
+                continue
+            if response.status in HTTP_RETRY_STATUSES:
+                error = f"HTTP {response.status}"
+                continue
+            return response
+        raise HttpError(f"{method} {url} failed: {error or 'timed out'}")
+
+    def _exchange(
+        self,
+        scheme: str,
+        host: str,
+        method: str,
+        target: str,
+        body: bytes | None,
+        headers: dict[str, str],
+        stream: bool = False,
+        fresh: bool = False,
+    ) -> HttpResponse:
+        conn, reused = self._checkout(scheme, host, self._timeout(), fresh)
+        try:
+            conn.request(method, target, body=body, headers=headers)
+            resp = conn.getresponse()
+            # Redirects and errors are small; only a wanted body streams.
+            streaming = stream and 200 <= resp.status < 300
+            data = b"" if streaming else resp.read()
+        except (OSError, http.client.HTTPException):
+            conn.close()
+            if not reused:
+                raise
+            # Most likely the server closed an idle keep-alive connection.
+            return self._exchange(
+                scheme, host, method, target, body, headers, stream, True
+            )
+        headers = {name.lower(): value for name, value in resp.getheaders()}
+        if streaming:
+            return HttpResponse(
+                resp.status,
+                headers,
+                data,
+                resp,
+                partial(self._release, scheme, host, conn, resp),
+            )
+        self._release(scheme, host, conn, resp)
+        return HttpResponse(resp.status, headers, data)
+
+    def _release(
+        self,
+        scheme: str,
+        host: str,
+        conn: http.client.HTTPConnection,
+        resp: http.client.HTTPResponse,
+    ) -> None:
+        # A body left partly unread would corrupt the next response.
+        if resp.will_close or not resp.isclosed():
+            conn.close()
+        else:
+            self._checkin(scheme, host, conn)
+
+    @staticmethod
+    def _timeout() -> float:
+        remaining = remaining_time()
+        return HTTP_TIMEOUT if remaining is None else min(remaining, HTTP_TIMEOUT)
+
+    def close(self) -> None:
+        with self._lock:
+            conns = [conn for idle in self._idle.values() for conn in idle]
+            self._idle.clear()
+        for conn in conns:
+            conn.close()
+
+
+HTTP = HttpClient(max_idle=NPM_FETCH_JOBS)
+
+
+def _pkt_line(payload: str) -> bytes:
+    data = payload.encode("utf-8")
+    return f"{len(data) + 4:04x}".encode("ascii") + data
+
+
+def _read_exactly(stream: IO[bytes], size: int) -> bytes:
+    data = b""
+    while len(data) < size:
+        chunk = stream.read(size - len(data))
+        if not chunk:
+            raise UpdateError("truncated git protocol response")
+        data += chunk
+    return data
+
+
+def _read_pkt_lines(stream: IO[bytes]) -> Iterator[bytes]:
+    while True:
+        length = int(_read_exactly(stream, 4), 16)
+        if length == 0:
+            return
+        if length < 4:
             continue
-        ref = parts[1]
-        if ref.startswith("refs/tags/"):
-            tags.append(ref[len("refs/tags/") :])
-    if not tags:
-        raise UpdateError(f"No tags found for {repo_url}.")
-    return tags
+        yield _read_exactly(stream, length - 4)
+
+
+def _ls_refs_http(repo_url: str, prefixes: Sequence[str]) -> list[str]:
+    """Ask a smart HTTP remote for tag refs with protocol v2 ls-refs.
+
+    Unlike `git ls-remote <pattern>`, which only sends `refs/tags/` to the
+    server and filters locally, each prefix becomes a ref-prefix argument, so
+    the server only sends back matching tags.
+    """
+    ref_prefixes = [f"refs/tags/{prefix}" for prefix in prefixes] or ["refs/tags/"]
+    body = (
+        _pkt_line("command=ls-refs\n")
+        + b"0001"
+        + b"".join(_pkt_line(f"ref-prefix {ref}\n") for ref in ref_prefixes)
+        + b"0000"
+    )
+    refs = []
+    with HTTP.stream(
+        repo_url.rstrip("/") + "/git-upload-pack",
+        method="POST",
+        body=body,
+        headers={
+            "Content-Type": "application/x-git-upload-pack-request",
+            "Accept": "application/x-git-upload-pack-result",
+            "Git-Protocol": "version=2",
+            "User-Agent": "git/update-pins",
+        },
+    ) as response:
+        # Parsed as the pkt-lines arrive rather than after the whole body.
+        for payload in _read_pkt_lines(response):
+            parts = payload.decode("utf-8").rstrip("\n").split(" ")
+            if len(parts) >= 2:
+                refs.append(parts[1])
+    return refs
+
+
+def _ls_remote(repo_url: str, prefixes: Sequence[str]) -> Iterator[str]:
+    patterns = [f"refs/tags/{prefix}*" for prefix in prefixes]
+    for line in stream_lines(
+        ["git", "ls-remote", "--tags", "--refs", repo_url, *patterns]
+    ):
+        parts = line.rstrip("\n").split("\t")
+        if len(parts) == 2:
+            yield parts[1]
+
+
+def _discover_tags(repo_url: str, prefixes: Sequence[str]) -> list[str]:
+    refs: Iterable[str]
+    tags: list[str] = []
+    if repo_url.startswith("https://"):
+        try:
+            refs = _ls_refs_http(repo_url, prefixes)
+            tags = [
+                ref[len("refs/tags/") :] for ref in refs if ref.startswith("refs/tags/")
+            ]
+        except (OSError, ValueError, UpdateError):
+            tags = []
+        if tags:
+            return tags
+    refs = _ls_remote(repo_url, prefixes)
+    return [ref[len("refs/tags/") :] for ref in refs if ref.startswith("refs/tags/")]
+
+
+def get_tags(repo_url: str, prefixes: Sequence[str] = ()) -> list[str]:
+    """Return tags for repo_url, limited to prefixes when any of them match."""
+    with TRACER.span("tags", repo_url):
+        return _get_tags(repo_url, prefixes)
+
+
+def _get_tags(repo_url: str, prefixes: Sequence[str]) -> list[str]:
+    for attempt in (tuple(prefixes), ()):
+        cached = TAG_CACHE.get(repo_url, attempt)
+        if cached:
+            return cached
+        tags = _discover_tags(repo_url, attempt)
+        if tags:
+            TAG_CACHE.put(repo_url, attempt, tags)
+            return tags
+        if not attempt:
+            break
+    raise UpdateError(f"No tags found for {repo_url}.")
 
 
 def version_key(tag: str) -> tuple[int, int, int, str]:
@@ -78,75 +971,908 @@ def select_latest_tag(tags: Iterable[str], preferred_prefixes: Sequence[str]) ->
     return tags_list[-1]
 
 
-def prefetch_sri(url: str) -> str:
+def prefetch_sri(url: str, unpack: bool = True, strip_root: bool = True) -> str:
+    """Return the SRI hash nix would record for url.
+
+    The download is hashed, or unpacked by archive_sri, as it arrives; nix
+    is only needed for archives that cannot be (zip, device nodes, ...).
+    """
+    with TRACER.span("prefetch", url):
+        try:
+            with HTTP.stream(url) as body:
+                if not unpack:
+                    hasher = hashlib.sha256()
+                    while chunk := body.read(1 << 16):
+                        hasher.update(chunk)
+                    return "sha256-" + base64.b64encode(hasher.digest()).decode()
+                return archive_sri(body, strip_root)
+        except UnsupportedArchive as exc:
+            if not strip_root:
+                # nix's --unpack always strips a lone top-level entry, so its
+                # hash is wrong for stripRoot = false archives with just one.
+                raise UpdateError(
+                    f"{url}: {exc}, and nix --unpack cannot hash "
+                    "stripRoot = false archives"
+                ) from exc
+            print(f"note: {url}: {exc}; using nix to hash it", file=sys.stderr)
+        return _nix_prefetch_sri(url, unpack)
+
+
+def _nix_prefetch_sri(url: str, unpack: bool) -> str:
+    unpack_flag = ["--unpack"] if unpack else []
     if which("nix"):
-        result = subprocess.run(
-            ["nix", "store", "prefetch-file", "--json", "--unpack", url],
-            text=True,
-            capture_output=True,
+        result = run(
+            ["nix", "store", "prefetch-file", "--json", *unpack_flag, url],
+            check=False,
         )
         if result.returncode == 0:
             data = json.loads(result.stdout)
             return data["hash"]
     if which("nix-prefetch-url"):
-        hash_result = run(["nix-prefetch-url", "--unpack", url])
+        hash_result = run(["nix-prefetch-url", *unpack_flag, url])
         base32_hash = hash_result.stdout.strip()
         sri_result = run(["nix", "hash", "to-sri", "--type", "sha256", base32_hash])
         return sri_result.stdout.strip()
     raise UpdateError("nix or nix-prefetch-url is required to compute source hashes.")
 
 
-def fetch_json(url: str) -> dict[str, object]:
-    with urlopen(url) as response:
-        return json.load(response)
-
-
-def update_codex() -> None:
-    tags = get_tags("https://github.com/openai/codex.git")
-    latest_tag = select_latest_tag(tags, preferred_prefixes=("rust-v",))
-
-    flake_text = FLAKE_PATH.read_text(encoding="utf-8")
-    if f"ref=refs/tags/{latest_tag}" in flake_text:
-        print(f"codex already at {latest_tag}")
-        return
-
-    pattern = (
-        r"(git\+https://github\.com/openai/codex\?ref=refs/tags/)([^&\"]+)([^\"]*)"
+def _prefetch_cached(url: str, strip_root: bool = True) -> str:
+    cached = PREFETCH_CACHE.get(url, unpack=True, strip_root=strip_root)
+    if cached and PREFETCH_CACHE.mode != "verify":
+        return cached
+    with _prefetch_slots:
+        sri = prefetch_sri(url, strip_root=strip_root)
+    if cached and cached != sri:
+        print(
+            f"warning: cached hash for {url} was {cached}, now {sri}",
+            file=sys.stderr,
+        )
+    PREFETCH_CACHE.put(url, True, sri, strip_root=strip_root)
+    return sri
+
+
+def prefetch_many(
+    urls: Iterable[str], unstripped: Container[str] = ()
+) -> dict[str, str]:
+    """Prefetch each distinct URL in parallel and return a URL -> SRI map.
+
+    URLs in unstripped are fetchzip { stripRoot = false; } archives.
+    """
+    unique = list(dict.fromkeys(urls))
+    if len(unique) == 1:
+        return {unique[0]: _prefetch_cached(unique[0], unique[0] not in unstripped)}
+
+    hashes: dict[str, str] = {}
+    errors: list[str] = []
+    with ThreadPoolExecutor(
+        max_workers=max(1, min(PREFETCH_JOBS, len(unique)))
+    ) as pool:
+        futures = {
+            pool.submit(
+                contextvars.copy_context().run,
+                _prefetch_cached,
+                url,
+                url not in unstripped,
+            ): url
+            for url in unique
+        }
+        for future, url in futures.items():
+            try:
+                hashes[url] = future.result()
+            except (UpdateError, OSError, ValueError, http.client.HTTPException) as exc:
+                errors.append(f"{url}: {exc}")
+    if errors:
+        raise UpdateError("prefetch failed for " + "; ".join(errors))
+    return hashes
+
+
+def fetch_json(url: str, accept: str = "") -> dict[str, object]:
+    """GET a JSON document, revalidating a cached copy with If-None-Match."""
+    headers = {"Accept": accept} if accept else {}
+    cached = ETAG_CACHE.get(url, accept)
+    if cached is not None:
+        headers["If-None-Match"] = cached[0]
+    response = HTTP.request(url, headers=headers)
+    if response.status == 304 and cached is not None:
+        return json.loads(cached[1])
+    text = response.body.decode("utf-8")
+    etag = response.headers.get("etag")
+    if etag:
+        ETAG_CACHE.put(url, accept, etag, text)
+    return json.loads(text)
+
+
+def fetch_bytes(url: str) -> bytes:
+    return HTTP.request(url).body
+
+
+def _nar_str(hasher: "hashlib._Hash", data: bytes) -> None:
+    hasher.update(len(data).to_bytes(8, "little"))
+    hasher.update(data)
+    hasher.update(b"\0" * (-len(data) % 8))
+
+
+def _nar_path(
+    hasher: "hashlib._Hash", path: Path, skip: frozenset[bytes] = frozenset()
+) -> None:
+    _nar_str(hasher, b"(")
+    _nar_str(hasher, b"type")
+    if path.is_symlink():
+        _nar_str(hasher, b"symlink")
+        _nar_str(hasher, b"target")
+        _nar_str(hasher, os.fsencode(os.readlink(path)))
+    elif path.is_dir():
+        _nar_str(hasher, b"directory")
+        for name in sorted(os.fsencode(entry) for entry in os.listdir(path)):
+            if name in skip:
+                continue
+            _nar_str(hasher, b"entry")
+            _nar_str(hasher, b"(")
+            _nar_str(hasher, b"name")
+            _nar_str(hasher, name)
+            _nar_str(hasher, b"node")
+            _nar_path(hasher, path / os.fsdecode(name), skip)
+            _nar_str(hasher, b")")
+    else:
+        _nar_str(hasher, b"regular")
+        if path.stat().st_mode & 0o100:
+            _nar_str(hasher, b"executable")
+            _nar_str(hasher, b"")
+        _nar_str(hasher, b"contents")
+        size = path.stat().st_size
+        hasher.update(size.to_bytes(8, "little"))
+        with path.open("rb") as handle:
+            while chunk := handle.read(1 << 20):
+                hasher.update(chunk)
+        hasher.update(b"\0" * (-size % 8))
+    _nar_str(hasher, b")")
+
+
+def nar_sri(path: Path, skip: Iterable[str] = ()) -> str:
+    """Return the sha256 SRI of path's NAR serialisation (`nix hash path`).
+
+    Entries named in skip are left out at every level.
+    """
+    hasher = hashlib.sha256()
+    _nar_str(hasher, b"nix-archive-1")
+    _nar_path(hasher, path, frozenset(os.fsencode(name) for name in skip))
+    return "sha256-" + base64.b64encode(hasher.digest()).decode("ascii")
+
+
+@dataclass(frozen=True)
+class _MemFile:
+    contents: bytes
+    executable: bool
+
+
+@dataclass(frozen=True)
+class _MemSymlink:
+    target: str
+
+
+# An unpacked archive held in memory: directories are name -> node dicts.
+_MemNode = dict[str, "_MemNode"] | _MemFile | _MemSymlink
+
+
+def _nar_node(hasher: "hashlib._Hash", node: _MemNode) -> None:
+    """Serialise an in-memory tree exactly as _nar_path would on disk."""
+    _nar_str(hasher, b"(")
+    _nar_str(hasher, b"type")
+    if isinstance(node, _MemSymlink):
+        _nar_str(hasher, b"symlink")
+        _nar_str(hasher, b"target")
+        _nar_str(hasher, node.target.encode("utf-8"))
+    elif isinstance(node, _MemFile):
+        _nar_str(hasher, b"regular")
+        if node.executable:
+            _nar_str(hasher, b"executable")
+            _nar_str(hasher, b"")
+        _nar_str(hasher, b"contents")
+        _nar_str(hasher, node.contents)
+    else:
+        _nar_str(hasher, b"directory")
+        for name in sorted(node, key=lambda name: name.encode("utf-8")):
+            _nar_str(hasher, b"entry")
+            _nar_str(hasher, b"(")
+            _nar_str(hasher, b"name")
+            _nar_str(hasher, name.encode("utf-8"))
+            _nar_str(hasher, b"node")
+            _nar_node(hasher, node[name])
+            _nar_str(hasher, b")")
+    _nar_str(hasher, b")")
+
+
+def _unpack_tar(fileobj: IO[bytes]) -> dict[str, _MemNode]:
+    """Unpack a (compressed) tarball into memory, streaming through tarfile.
+
+    Only the unpacked files are kept; the compressed stream is read once.
+    """
+    root: dict[str, _MemNode] = {}
+    try:
+        with tarfile.open(fileobj=fileobj, mode="r|*") as tar:
+            for member in tar:
+                parts = [
+                    part for part in member.name.split("/") if part not in ("", ".")
+                ]
+                if not parts:
+                    continue
+                if ".." in parts:
+                    raise UnsupportedArchive(f"unsafe path {member.name!r}")
+                parent = root
+                for part in parts[:-1]:
+                    child = parent.setdefault(part, {})
+                    if not isinstance(child, dict):
+                        raise UnsupportedArchive(f"{member.name!r} is under a file")
+                    parent = child
+                name = parts[-1]
+                if member.isdir():
+                    if not isinstance(parent.get(name), dict):
+                        parent[name] = {}
+                elif member.isreg():
+                    handle = tar.extractfile(member)
+                    assert handle is not None
+                    # nix canonicalises permissions to the owner execute bit.
+                    parent[name] = _MemFile(handle.read(), bool(member.mode & 0o100))
+                elif member.issym():
+                    parent[name] = _MemSymlink(member.linkname)
+                elif member.islnk():
+                    # Hard links unpack to a second copy of an earlier file.
+                    target: _MemNode = root
+                    for part in member.linkname.split("/"):
+                        if part in ("", "."):
+                            continue
+                        if not isinstance(target, dict) or part not in target:
+                            raise UnsupportedArchive(
+                                f"hard link to missing {member.linkname!r}"
+                            )
+                        target = target[part]
+                    if not isinstance(target, _MemFile):
+                        raise UnsupportedArchive(f"hard link to {member.linkname!r}")
+                    parent[name] = target
+                else:
+                    raise UnsupportedArchive(f"cannot unpack {member.name!r}")
+    except (tarfile.TarError, EOFError, OSError) as exc:
+        raise UnsupportedArchive(f"not a tarball ({exc})") from exc
+    return root
+
+
+def archive_sri(fileobj: IO[bytes], strip_root: bool = True) -> str:
+    """Hash a tarball the way fetchzip / `nix store prefetch-file --unpack` do.
+
+    With strip_root the archive must hold exactly one top-level entry: a
+    directory becomes the root, while a lone file is kept inside one, as
+    fetchzip does. The NAR is hashed straight from memory.
+    """
+    root: _MemNode = _unpack_tar(fileobj)
+    if strip_root:
+        if len(root) != 1:
+            raise UnsupportedArchive(f"expected one top-level entry, found {len(root)}")
+        ((name, top),) = root.items()
+        root = top if isinstance(top, dict) else {name: top}
+    hasher = hashlib.sha256()
+    _nar_str(hasher, b"nix-archive-1")
+    _nar_node(hasher, root)
+    return "sha256-" + base64.b64encode(hasher.digest()).decode("ascii")
+
+
+# Strongest first, matching ssri's choice of "best" integrity hash.
+_INTEGRITY_ALGOS = ("sha512", "sha384", "sha256", "sha1")
+
+
+def _best_integrity(integrity: str) -> str:
+    hashes = {}
+    for item in integrity.split():
+        algo, _, digest = item.partition("-")
+        if algo in _INTEGRITY_ALGOS and digest:
+            hashes.setdefault(algo, item)
+    for algo in _INTEGRITY_ALGOS:
+        if algo in hashes:
+            return hashes[algo]
+    raise UnsupportedLockfile(f"unusable integrity {integrity!r}")
+
+
+def _npm_lock_tarballs(lock_text: str) -> dict[str, str]:
+    """Return resolved URL -> integrity for every cacheable lockfile entry."""
+    lock = json.loads(lock_text)
+    if lock.get("lockfileVersion") not in (2, 3):
+        raise UnsupportedLockfile(
+            f"lockfileVersion {lock.get('lockfileVersion')} is not supported"
+        )
+    tarballs: dict[str, str] = {}
+    for name, package in lock.get("packages", {}).items():
+        resolved = package.get("resolved")
+        if not name or not isinstance(resolved, str):
+            continue
+        scheme = resolved.split(":", 1)[0]
+        if scheme not in ("http", "https") or "://" not in resolved:
+            # Relative workspace links are skipped by nixpkgs as well; git and
+            # other URL schemes need its git packing logic.
+            if scheme in ("git", "git+ssh", "git+https", "github", "ssh"):
+                raise UnsupportedLockfile(f"git dependency {name}")
+            continue
+        url = resolved.split("#", 1)[0]
+        host = url.split("/")[2]
+        if host in ("github.com", "codeload.github.com", "gitlab.com", "bitbucket.org"):
+            raise UnsupportedLockfile(f"hosted git dependency {name}")
+        integrity = package.get("integrity")
+        if not isinstance(integrity, str):
+            raise UnsupportedLockfile(f"{name} has no integrity")
+        best = _best_integrity(integrity)
+        if tarballs.setdefault(url, best) != best:
+            raise UnsupportedLockfile(f"conflicting integrity for {url}")
+    if not tarballs:
+        raise UnsupportedLockfile("no cacheable dependencies")
+    return tarballs
+
+
+def _cacache_put(cache: Path, url: str, integrity: str, data: bytes) -> None:
+    algo, _, digest_b64 = integrity.partition("-")
+    expected = base64.b64decode(digest_b64)
+    if hashlib.new(algo, data).digest() != expected:
+        raise UpdateError(f"integrity mismatch for {url}")
+
+    digest_hex = expected.hex()
+    content = cache / "content-v2" / algo / digest_hex[:2] / digest_hex[2:4]
+    content.mkdir(parents=True, exist_ok=True)
+    (content / digest_hex[4:]).write_bytes(data)
+
+    key = f"make-fetch-happen:request-cache:{url}"
+    key_hex = hashlib.sha256(key.encode("utf-8")).hexdigest()
+    index = cache / "index-v5" / key_hex[:2] / key_hex[2:4]
+    index.mkdir(parents=True, exist_ok=True)
+    entry = json.dumps(
+        {
+            "key": key,
+            "integrity": integrity,
+            "time": 0,
+            "size": len(data),
+            "metadata": {"url": url, "options": {"compress": True}},
+        },
+        separators=(",", ":"),
+        ensure_ascii=False,
     )
-    updated = replace_one(
-        pattern,
-        rf"\g<1>{latest_tag}\g<3>",
-        flake_text,
-        "codex tag",
+    sha1 = hashlib.sha1(entry.encode("utf-8")).hexdigest()
+    (index / key_hex[4:]).write_text(f"{sha1}\t{entry}", encoding="utf-8")
+
+
+def npm_lock_shape(name: str, lock_text: str) -> str:
+    """Describe what npm_deps_hash relies on in lock_text, for NPM_SHAPES.
+
+    Two lockfiles of one target with the same version and integrity
+    algorithms take the same path through prefetch-npm-deps.
+    """
+    version = json.loads(lock_text).get("lockfileVersion")
+    algos = sorted(
+        {
+            integrity.partition("-")[0]
+            for integrity in _npm_lock_tarballs(lock_text).values()
+        }
     )
+    return f"{name} lockfileVersion={version} {'+'.join(algos)}"
+
+
+def npm_deps_hash(lock_text: str) -> str:
+    """Compute npmDepsHash without nix by rebuilding fetchNpmDeps' output.
+
+    This mirrors nixpkgs' prefetch-npm-deps: each registry tarball is stored
+    in an npm cacache under _cacache, the lockfile is copied alongside, and
+    the fixed-output hash is the NAR hash of that directory.
+    """
+    tarballs = _npm_lock_tarballs(lock_text)
+    with (
+        TRACER.span("npm-hash", f"{len(tarballs)} tarballs"),
+        tempfile.TemporaryDirectory(prefix="npm-deps-") as tmp,
+    ):
+        out = Path(tmp) / "out"
+        cache = out / "_cacache"
+        (cache / "content-v2").mkdir(parents=True)
+        (cache / "index-v5").mkdir()
+
+        def fetch(url: str) -> None:
+            _cacache_put(cache, url, tarballs[url], fetch_bytes(url))
+
+        with ThreadPoolExecutor(max_workers=NPM_FETCH_JOBS) as pool:
+            futures = [
+                pool.submit(contextvars.copy_context().run, fetch, url)
+                for url in tarballs
+            ]
+            for future in futures:
+                future.result()
+
+        (out / "package-lock.json").write_text(lock_text, encoding="utf-8")
+        return nar_sri(out)
+
+
+def direct_npm_deps_hash(
+    name: str, lock_url: str, fixup: Callable[[str], str] | None = None
+) -> tuple[str, str] | None:
+    """Hash the lockfile at lock_url directly, or None if nix must do it.
+
+    Returns the hash and the lockfile's shape (see npm_lock_shape).
+    """
+    try:
+        lock_text = fetch_bytes(lock_url).decode("utf-8")
+        if fixup is not None:
+            lock_text = fixup(lock_text)
+        return npm_deps_hash(lock_text), npm_lock_shape(name, lock_text)
+    except (UpdateError, OSError, ValueError, KeyError, TypeError) as exc:
+        # UpdateError covers an integrity mismatch; KeyError and TypeError a
+        # lockfile the fixup did not expect.
+        print(
+            f"note: hashing {lock_url} directly failed ({exc!r}); using nix build",
+            file=sys.stderr,
+        )
+        return None
+
+
+def scrypted_lock_fixup(lock_text: str) -> str:
+    """Apply the package-lock.json edit from postPatch in pkgs/scrypted.nix.
+
+    fetchNpmDeps runs postPatch before hashing, so keep this in sync with the
+    node snippet there (including JSON.stringify's two-space layout).
+    """
+    lock = json.loads(lock_text)
+    root = lock["packages"][""]
+    root["dependencies"] = root.get("dependencies") or {}
+    root["dependencies"]["node-addon-api"] = "^8.3.1"
+    lock["packages"]["node_modules/node-addon-api"] = {
+        "version": "8.3.1",
+        "resolved": "https://registry.npmjs.org/node-addon-api/-/node-addon-api-8.3.1.tgz",
+        "integrity": "sha512-lytcDEdxKjGJPTLEfW4mYMigRezMlyJY8W4wxJK8zE533Jlb8L8dRuObJFWg2P+AuOIxoCgKF+2Oq4d4Zd0OUA==",
+        "license": "MIT",
+    }
+    return json.dumps(lock, indent=2, ensure_ascii=False) + "\n"
+
+
+def _resolve_git_ref(url: str, ref: str) -> str:
+    """Return the commit ref points at, peeling annotated tags."""
+    revs = {}
+    for line in stream_lines(["git", "ls-remote", url, ref, f"{ref}^{{}}"]):
+        rev, _, name = line.rstrip("\n").partition("\t")
+        revs[name] = rev
+    rev = revs.get(f"{ref}^{{}}") or revs.get(ref)
+    if not rev:
+        raise UpdateError(f"{ref} not found in {url}")
+    return rev
+
+
+# Keep the user's git config from changing checked-out bytes, which nix
+# hashes straight from the git objects. `-c` reaches submodule clones too.
+_PRISTINE_CHECKOUT = (
+    "-c",
+    "core.autocrlf=false",
+    "-c",
+    "core.eol=lf",
+    "-c",
+    "core.attributesFile=/dev/null",
+    "-c",
+    "filter.lfs.smudge=",
+    "-c",
+    "filter.lfs.process=",
+    "-c",
+    "filter.lfs.required=false",
+)
+
+
+def git_input_lock(url: str, ref: str, submodules: bool) -> dict[str, object]:
+    """Compute a git flake input's locked attributes without nix.
+
+    nix clones the full repository (and every submodule) to lock a git
+    input. Here a treeless fetch of the history gives revCount and
+    lastModified, and a depth-1 checkout gives narHash.
+    """
+    rev = _resolve_git_ref(url, ref)
+    cached = LOCK_CACHE.get(url, rev)
+    if cached is not None:
+        return cached
+    with tempfile.TemporaryDirectory(prefix="update-pins-git-") as tmp:
+        history = Path(tmp) / "history.git"
+        run(["git", "init", "-q", "--bare", str(history)])
+        run(
+            [
+                "git",
+                "-C",
+                str(history),
+                "fetch",
+                "-q",
+                "--no-tags",
+                "--filter=tree:0",
+                url,
+                f"+{ref}:{ref}",
+            ]
+        )
+        rev_count = run(["git", "-C", str(history), "rev-list", "--count", rev])
+        committed = run(["git", "-C", str(history), "log", "-1", "--format=%ct", rev])
 
-    FLAKE_PATH.write_text(updated, encoding="utf-8")
-    print(f"codex -> {latest_tag}")
-
-    if which("nix"):
-        subprocess.run(
+        checkout = Path(tmp) / "checkout"
+        recurse = ["--recurse-submodules", "--shallow-submodules"] if submodules else []
+        run(
             [
-                "nix",
-                "flake",
-                "update",
-                "--update-input",
-                "codex",
-                "--option",
-                "warn-dirty",
-                "false",
-            ],
-            check=True,
-            cwd=REPO_ROOT,
+                "git",
+                *_PRISTINE_CHECKOUT,
+                "clone",
+                "-q",
+                "--depth",
+                "1",
+                "--branch",
+                ref.removeprefix("refs/tags/").removeprefix("refs/heads/"),
+                *recurse,
+                url,
+                str(checkout),
+            ]
         )
-    else:
-        print("nix not found, skipping flake.lock update")
+        head = run(["git", "-C", str(checkout), "rev-parse", "HEAD"]).stdout.strip()
+        if head != rev:
+            raise UpdateError(f"{url} {ref} moved while locking ({rev} -> {head})")
+        locked: dict[str, object] = {
+            "lastModified": int(committed.stdout.strip()),
+            "narHash": nar_sri(checkout, skip=(".git",)),
+            "ref": ref,
+            "rev": rev,
+            "revCount": int(rev_count.stdout.strip()),
+        }
+    LOCK_CACHE.put(url, rev, locked)
+    return locked
+
+
+def update_codex_lock() -> None:
+    """Point flake.lock's codex node at the tag flake.nix now references.
+
+    The node is written directly from git_input_lock. `nix flake update` is
+    only run when that fails, or, with --verify-lock, to cross-check it.
+    """
+    ref = "refs/tags/" + read_field(
+        FLAKE_PATH.read_text(encoding="utf-8"), "codexRef", "codex in flake.nix"
+    )
+    lock = json.loads(FLAKE_LOCK_PATH.read_text(encoding="utf-8"))
+    node = lock["nodes"]["codex"]
+    try:
+        locked = git_input_lock(
+            str(node["locked"]["url"]),
+            ref,
+            bool(node["locked"].get("submodules", False)),
+        )
+    except (UpdateError, OSError, ValueError) as exc:
+        if not which("nix"):
+            raise
+        print(
+            f"note: locking codex directly failed ({exc}); using nix", file=sys.stderr
+        )
+        _nix_update_codex_lock()
+        return
+    node["locked"].update(locked)
+    node["original"]["ref"] = ref
+    write_atomic(FLAKE_LOCK_PATH, json.dumps(lock, indent=2) + "\n")
+    if LOCK_CACHE.mode == "verify":
+        _verify_codex_lock(locked)
 
 
-def compute_homebridge_npm_hash() -> str:
+def _verify_codex_lock(locked: dict[str, object]) -> None:
+    """Re-lock codex with nix and report any attribute that disagrees."""
     if not which("nix"):
-        raise UpdateError("nix is required to compute npmDepsHash.")
+        raise UpdateError("--verify-lock needs nix")
+    _nix_update_codex_lock()
+    lock = json.loads(FLAKE_LOCK_PATH.read_text(encoding="utf-8"))
+    from_nix = lock["nodes"]["codex"]["locked"]
+    differs = [
+        f"{key}: {value} (nix: {from_nix.get(key)})"
+        for key, value in locked.items()
+        if from_nix.get(key) != value
+    ]
+    if differs:
+        raise UpdateError(
+            "direct codex lock disagreed with nix, kept nix's: " + "; ".join(differs)
+        )
+
 
-    expr = "\n".join(
+def _nix_update_codex_lock() -> None:
+    if not which("nix"):
+        print("nix not found, skipping flake.lock update")
+        return
+    run(
+        [
+            "nix",
+            "flake",
+            "update",
+            "--update-input",
+            "codex",
+            "--option",
+            "warn-dirty",
+            "false",
+        ],
+        cwd=REPO_ROOT,
+    )
+
+
+@dataclass(frozen=True)
+class Asset:
+    """A hash binding filled in by prefetching url (a PinSpec template)."""
+
+    binding: str
+    url: str
+    # fetchzip's stripRoot.
+    strip_root: bool = True
+
+
+@dataclass(frozen=True)
+class NpmDeps:
+    """Where to find the lockfile behind a buildNpmPackage npmDepsHash."""
+
+    lock_url: str
+    fixup: Callable[[str], str] | None = None
+    binding: str = "npmDepsHash"
+
+
+@dataclass(frozen=True)
+class PinSpec:
+    """Declarative description of one pinned upstream.
+
+    upstream is a git repo URL whose tags are matched against tag_prefixes,
+    or, with source="npm", a registry packument whose dist-tags.latest is the
+    version and whose tag is tag_format. Templates may use {tag}, {version} and the
+    UPSTREAMS bases. version_field holds the tag instead of the version when
+    pin_tag is set.
+    """
+
+    name: str
+    path: Path
+    upstream: str
+    source: str = "git"
+    tag_prefixes: tuple[str, ...] = ()
+    tag_format: str = "v{version}"
+    version_field: str = "version"
+    pin_tag: bool = False
+    assets: tuple[Asset, ...] = ()
+    npm_deps: NpmDeps | None = None
+    after_write: Callable[[], None] | None = None
+    # Seconds between upstream polls in watch mode.
+    poll_interval: float = DEFAULT_POLL_INTERVAL
+
+    def url(self, template: str, tag: str, version: str) -> str:
+        return template.format(tag=tag, version=version, **UPSTREAMS)
+
+
+UPSTREAMS = {
+    "github": "https://github.com",
+    "raw": "https://raw.githubusercontent.com",
+    "npm": "https://registry.npmjs.org",
+}
+
+# One `name = value;` binding per line; name may be an attrpath.
+BINDING_RE = re.compile(
+    r'^[ \t]*(?P<name>[A-Za-z_][\w.\'-]*) = (?P<value>"[^"\n]*"|[^;"\n]+);',
+    re.M,
+)
+# The codex input's tag inside flake.nix's url binding, indexed as "codexRef".
+CODEX_REF_RE = re.compile(
+    r"git\+https://github\.com/openai/codex\?ref=refs/tags/(?P<ref>[^&\"]+)"
+)
+# Bindings that may hold an expression (lib.fakeHash, ...) rather than a
+# string; they are rewritten as strings.
+EXPR_BINDINGS = frozenset({"npmDepsHash"})
+
+
+@dataclass(frozen=True)
+class Binding:
+    """Where a binding's value sits in the text, quotes included."""
+
+    start: int
+    end: int
+    value: str
+    literal: bool
+    # Raw spans (the codex ref, inside a URL string) are replaced unquoted.
+    raw: bool = False
+
+
+def index_bindings(text: str) -> dict[str, list[Binding]]:
+    """Find every binding, and the codex flake ref, in one pass over text."""
+    index: dict[str, list[Binding]] = defaultdict(list)
+    for match in BINDING_RE.finditer(text):
+        start, end = match.span("value")
+        value = match.group("value")
+        literal = value.startswith('"')
+        index[match.group("name")].append(
+            Binding(start, end, value.strip('"') if literal else value.strip(), literal)
+        )
+        ref = CODEX_REF_RE.search(value)
+        if ref is not None:
+            index["codexRef"].append(
+                Binding(
+                    start + ref.start("ref"),
+                    start + ref.end("ref"),
+                    ref.group("ref"),
+                    literal=True,
+                    raw=True,
+                )
+            )
+    return index
+
+
+def _bindings(index: dict[str, list[Binding]], binding: str) -> list[Binding]:
+    return [
+        found
+        for found in index.get(binding, ())
+        if found.literal or binding in EXPR_BINDINGS
+    ]
+
+
+def read_field(text: str, binding: str, label: str) -> str:
+    matches = _bindings(index_bindings(text), binding)
+    if not matches:
+        raise UpdateError(f"Could not find {label} {binding}.")
+    return matches[0].value
+
+
+def set_fields(text: str, values: dict[str, str], label: str) -> str:
+    """Rewrite every binding in values in a single pass over text.
+
+    Each binding must occur exactly once, as with the old per-field regexes.
+    """
+    index = index_bindings(text)
+    edits = []
+    for binding, value in values.items():
+        matches = _bindings(index, binding)
+        if len(matches) != 1:
+            raise UpdateError(
+                f"Expected 1 match for {label} {binding}, found {len(matches)}."
+            )
+        found = matches[0]
+        edits.append((found.start, found.end, value if found.raw else f'"{value}"'))
+    edits.sort()
+    pieces = []
+    pos = 0
+    for start, end, replacement in edits:
+        pieces += [text[pos:start], replacement]
+        pos = end
+    pieces.append(text[pos:])
+    return "".join(pieces)
+
+
+PINS: dict[str, PinSpec] = {
+    spec.name: spec
+    for spec in (
+        PinSpec(
+            name="codex",
+            path=FLAKE_PATH,
+            upstream="{github}/openai/codex.git",
+            tag_prefixes=("rust-v",),
+            version_field="codexRef",
+            pin_tag=True,
+            after_write=update_codex_lock,
+            poll_interval=15 * 60,
+        ),
+        PinSpec(
+            name="homebridge",
+            path=HOMEBRIDGE_PATH,
+            upstream="{github}/homebridge/homebridge.git",
+            tag_prefixes=("v",),
+            assets=(
+                Asset(
+                    "githubHash",
+                    "{github}/homebridge/homebridge/archive/refs/tags/{tag}.tar.gz",
+                ),
+            ),
+            npm_deps=NpmDeps(
+                "{raw}/homebridge/homebridge/{tag}/package-lock.json",
+            ),
+        ),
+        PinSpec(
+            name="scrypted",
+            path=SCRYPTED_PATH,
+            upstream="{npm}/@scrypted%2Fserver",
+            source="npm",
+            assets=(
+                Asset(
+                    "srcHash",
+                    "{github}/koush/scrypted/archive/refs/tags/{tag}.tar.gz",
+                ),
+            ),
+            npm_deps=NpmDeps(
+                "{raw}/koush/scrypted/{tag}/server/package-lock.json",
+                fixup=scrypted_lock_fixup,
+            ),
+        ),
+        PinSpec(
+            name="mole",
+            path=MOLE_PATH,
+            upstream="{github}/tw93/Mole.git",
+            tag_prefixes=("V", "v"),
+            assets=(
+                Asset("srcHash", "{github}/tw93/Mole/archive/refs/tags/{tag}.tar.gz"),
+                Asset(
+                    "binariesHashArm64",
+                    "{github}/tw93/Mole/releases/download/{tag}/"
+                    "binaries-darwin-arm64.tar.gz",
+                    strip_root=False,
+                ),
+                Asset(
+                    "binariesHashAmd64",
+                    "{github}/tw93/Mole/releases/download/{tag}/"
+                    "binaries-darwin-amd64.tar.gz",
+                    strip_root=False,
+                ),
+            ),
+        ),
+        PinSpec(
+            name="ramp",
+            path=RAMP_CLI_PATH,
+            upstream="{github}/ramp-public/ramp-cli.git",
+            tag_prefixes=("v",),
+            assets=(
+                Asset(
+                    "hash",
+                    "{github}/ramp-public/ramp-cli/archive/refs/tags/{tag}.tar.gz",
+                ),
+            ),
+        ),
+    )
+}
+
+
+def resolve_latest(spec: PinSpec) -> tuple[str, str]:
+    """Return (tag, version) for the newest upstream release of spec."""
+    upstream = spec.url(spec.upstream, "", "")
+    if spec.source == "npm":
+        # The abbreviated packument is revalidated with its ETag, so an
+        # unchanged package costs a 304.
+        packument = fetch_json(upstream, accept=NPM_ABBREVIATED)
+        dist_tags = packument.get("dist-tags")
+        version = dist_tags.get("latest") if isinstance(dist_tags, dict) else None
+        if not isinstance(version, str) or not version:
+            raise UpdateError(
+                f"Could not find latest {spec.name} version in npm registry response."
+            )
+        return spec.tag_format.format(version=version), version
+
+    tags = get_tags(upstream, spec.tag_prefixes)
+    tag = select_latest_tag(tags, preferred_prefixes=spec.tag_prefixes)
+    if not spec.tag_prefixes:
+        return tag, tag
+    for prefix in spec.tag_prefixes:
+        if tag.startswith(prefix):
+            return tag, tag[len(prefix) :]
+    raise UpdateError(f"Unexpected {spec.name} tag format: {tag}")
+
+
+@dataclass
+class PendingNpmHash:
+    """An npmDepsHash that must come from a nix build hash mismatch."""
+
+    target: str
+    # Relative to the workspace root.
+    path: Path
+    # fetchNpmDeps derivation name, "${pname}-${version}-npm-deps".
+    drv_name: str
+
+
+FOD_MISMATCH_RE = re.compile(
+    r"hash mismatch in fixed-output derivation '(?P<drv>[^']+)':"
+    r"\s*specified:\s*\S+\s*got:\s*(?P<got>sha256-[A-Za-z0-9+/=]+)"
+)
+
+
+def snapshot_flake() -> dict[str, str]:
+    return {
+        name: (REPO_ROOT / name).read_text(encoding="utf-8") for name in STAGED_FILES
+    }
+
+
+def stage_workspace(dest: Path, snapshot: dict[str, str]) -> None:
+    """Lay out a private copy of the flake in dest for nix to evaluate."""
+    for name, text in snapshot.items():
+        (dest / name).write_text(text, encoding="utf-8")
+    for name in STAGED_DIRS:
+        # Skip write_atomic's temp files from targets writing concurrently.
+        copytree(REPO_ROOT / name, dest / name, ignore=ignore_patterns(".*"))
+
+
+def _pkgs_expr(attrs: Iterable[str]) -> str:
+    """A nix expression for an attrset over this flake's nixpkgs.
+
+    Each of attrs is a `name = value;` line that can refer to pkgs; the
+    expression is evaluated relative to the current directory.
+    """
+    return "\n".join(
         [
             "let",
             "  flake = builtins.getFlake (toString ./.);",
@@ -158,321 +1884,1083 @@ def compute_homebridge_npm_hash() -> str:
             "    system = builtins.currentSystem;",
             "    overlays = [overlaySkipNodeChecks];",
             "  };",
-            "in pkgs.callPackage ./pkgs/homebridge.nix {}",
+            "in {",
+            *(f"  {attr}" for attr in attrs),
+            "}",
         ]
     )
-    build = subprocess.run(
-        ["nix", "build", "--impure", "--expr", expr, "--no-link"],
-        text=True,
-        capture_output=True,
-        cwd=REPO_ROOT,
-    )
-    output = f"{build.stdout}\n{build.stderr}"
-    if build.returncode == 0:
-        raise UpdateError("nix build succeeded, expected npmDepsHash mismatch.")
-
-    matches = re.findall(r"sha256-[A-Za-z0-9+/=]+", output)
-    if not matches:
-        raise UpdateError("Failed to locate npmDepsHash in nix build output.")
-    return matches[-1]
-
 
-def update_homebridge() -> None:
-    tags = get_tags("https://github.com/homebridge/homebridge.git")
-    latest_tag = select_latest_tag(tags, preferred_prefixes=("v",))
-    if not latest_tag.startswith("v"):
-        raise UpdateError(f"Unexpected homebridge tag format: {latest_tag}")
 
-    latest_version = latest_tag[1:]
-    original_text = HOMEBRIDGE_PATH.read_text(encoding="utf-8")
+def compute_npm_hashes(
+    pending: Sequence[PendingNpmHash], workspace: Path
+) -> dict[str, str]:
+    """Build every pending npmDeps derivation in one nix invocation.
 
-    version_match = re.search(r'^\s*version = "([^"]+)";', original_text, re.M)
-    if not version_match:
-        raise UpdateError("Could not find homebridge version in pkgs/homebridge.nix")
-
-    current_version = version_match.group(1)
-    if current_version == latest_version:
-        print(f"homebridge already at {latest_version}")
-        return
+    nix evaluates workspace, a staged copy of the flake, never the live tree.
+    All packages share a single flake + nixpkgs evaluation and are built with
+    --keep-going, so each hash mismatch is reported. Mismatches are mapped
+    back to targets by derivation name rather than by output order.
+    """
+    if not which("nix"):
+        raise UpdateError("nix is required to compute npmDepsHash.")
 
-    src_url = (
-        "https://github.com/homebridge/homebridge/archive/refs/tags/"
-        f"{latest_tag}.tar.gz"
+    expr = _pkgs_expr(
+        f"{item.target} = (pkgs.callPackage ./{item.path} {{}}).npmDeps;"
+        for item in pending
     )
-    src_hash = prefetch_sri(src_url)
+    with TRACER.span("npm-build", " ".join(item.target for item in pending)):
+        build = run(
+            [
+                "nix",
+                "build",
+                "--impure",
+                "--keep-going",
+                "--no-link",
+                "--expr",
+                expr,
+                *(item.target for item in pending),
+            ],
+            check=False,
+            cwd=workspace,
+        )
+    output = f"{build.stdout}\n{build.stderr}"
 
-    updated = replace_one(
-        r'^(\s*version = ")[^"]+(";)',
-        rf"\g<1>{latest_version}\g<2>",
-        original_text,
-        "homebridge version",
+    by_name = {item.drv_name: item.target for item in pending}
+    hashes: dict[str, str] = {}
+    for match in FOD_MISMATCH_RE.finditer(output):
+        # /nix/store/<hash>-<name>.drv
+        drv_name = match.group("drv").rsplit("/", 1)[-1].split("-", 1)[-1]
+        target = by_name.get(drv_name.removesuffix(".drv"))
+        if target is not None:
+            hashes[target] = match.group("got")
+    return hashes
+
+
+@dataclass
+class TargetState:
+    """Mutable progress of one target while its plan executes."""
+
+    spec: PinSpec
+    original: str = ""
+    current: str = ""
+    tag: str = ""
+    version: str = ""
+    up_to_date: bool = False
+    values: dict[str, str] = field(default_factory=dict)
+    needs_build: bool = False
+    # A direct npmDepsHash of an untrusted lockfile shape, for the nix build
+    # to confirm: (hash, shape).
+    unconfirmed_npm: tuple[str, str] | None = None
+    # Steps a previous run already finished, from the journal.
+    done: set[str] = field(default_factory=set)
+    error: str = ""
+    started: float | None = None
+    finished: float | None = None
+
+    @property
+    def pinned(self) -> str:
+        return self.tag if self.spec.pin_tag else self.version
+
+    @property
+    def active(self) -> bool:
+        return not self.error and not self.up_to_date
+
+
+@dataclass
+class Step:
+    """One unit of network or nix work; runs once every dep has finished."""
+
+    id: str
+    kind: str
+    action: Callable[[], None]
+    deps: tuple[str, ...] = ()
+    # Targets this step works for; shared steps list several.
+    targets: tuple[str, ...] = ()
+
+
+@dataclass
+class Plan:
+    states: dict[str, TargetState]
+    steps: dict[str, Step]
+
+    def describe(self) -> str:
+        lines = []
+        for step in self.steps.values():
+            after = f" after {', '.join(step.deps)}" if step.deps else ""
+            lines.append(f"  {step.id}{after}")
+        return "\n".join(lines)
+
+
+def _lookup(state: TargetState) -> None:
+    spec = state.spec
+    state.original = spec.path.read_text(encoding="utf-8")
+    state.current = read_field(
+        state.original, spec.version_field, f"{spec.name} in {spec.path.name}"
     )
-    updated = replace_one(
-        r'^(\s*githubHash = ")[^"]+(";)',
-        rf"\g<1>{src_hash}\g<2>",
-        updated,
-        "homebridge githubHash",
+    state.tag, state.version = resolve_latest(spec)
+    state.up_to_date = state.current == state.pinned
+
+
+def _resume(state: TargetState) -> bool:
+    """Pick up where the journal says an earlier run stopped, if it can."""
+    spec = state.spec
+    entry = JOURNAL.get(spec.name)
+    if entry is None:
+        return False
+    done = {str(step) for step in entry["done"]}
+    state.tag, state.version = str(entry["tag"]), str(entry["version"])
+    # Only trust the entry while the file holds what that run started from,
+    # or what it wrote if it stopped just after writing.
+    expected = state.pinned if "write" in done else entry["from"]
+    if state.current != expected:
+        JOURNAL.finish(spec.name)
+        return False
+    state.done = done
+    values = entry["values"]
+    assert isinstance(values, dict)
+    state.values.update(values)
+    print(f"{spec.name}: resuming {state.pinned} after {', '.join(sorted(done))}")
+    return True
+
+
+def _resolve(state: TargetState) -> None:
+    spec = state.spec
+    state.original = spec.path.read_text(encoding="utf-8")
+    state.current = read_field(
+        state.original, spec.version_field, f"{spec.name} in {spec.path.name}"
     )
+    if _resume(state):
+        return
+    state.tag, state.version = resolve_latest(spec)
+    state.up_to_date = state.current == state.pinned
+    if state.up_to_date:
+        print(f"{spec.name} already at {state.pinned}")
+        return
+    state.values[spec.version_field] = state.pinned
+    JOURNAL.start(spec.name, state.current, state.tag, state.version, state.values)
 
-    with_fake = replace_one(
-        r"^(\s*npmDepsHash = ).*?;",
-        rf'\g<1>"{FAKE_SRI}";',
-        updated,
-        "homebridge npmDepsHash",
-    )
-
-    HOMEBRIDGE_PATH.write_text(with_fake, encoding="utf-8")
-
-    try:
-        npm_hash = compute_homebridge_npm_hash()
-    except Exception:
-        HOMEBRIDGE_PATH.write_text(original_text, encoding="utf-8")
-        raise
 
-    final_text = replace_one(
-        r"^(\s*npmDepsHash = ).*?;",
-        rf'\g<1>"{npm_hash}";',
-        updated,
-        "homebridge npmDepsHash",
-    )
+def _prefetch(state: TargetState) -> None:
+    if not state.active or not state.spec.assets or "prefetch" in state.done:
+        return
+    urls = {
+        asset.binding: state.spec.url(asset.url, state.tag, state.version)
+        for asset in state.spec.assets
+    }
+    unstripped = {
+        urls[asset.binding] for asset in state.spec.assets if not asset.strip_root
+    }
+    hashes = prefetch_many(urls.values(), unstripped)
+    for binding, url in urls.items():
+        state.values[binding] = hashes[url]
+    JOURNAL.record(state.spec.name, "prefetch", state.values)
+
+
+def _npm_hash(state: TargetState) -> None:
+    npm_deps = state.spec.npm_deps
+    if not state.active or npm_deps is None or "npm" in state.done:
+        return
+    lock_url = state.spec.url(npm_deps.lock_url, state.tag, state.version)
+    direct = direct_npm_deps_hash(state.spec.name, lock_url, fixup=npm_deps.fixup)
+    if direct is None:
+        state.needs_build = True
+    elif not NPM_SHAPES.trusted(direct[1]):
+        # The first lockfile of this shape is hashed by fetchNpmDeps as well.
+        print(f"{state.spec.name}: confirming npmDepsHash with nix ({direct[1]})")
+        state.unconfirmed_npm = direct
+        state.needs_build = True
+    else:
+        state.values[npm_deps.binding] = direct[0]
+        JOURNAL.record(state.spec.name, "npm", state.values)
 
-    HOMEBRIDGE_PATH.write_text(final_text, encoding="utf-8")
-    print(f"homebridge -> {latest_version}")
 
+def _write(state: TargetState) -> None:
+    if not state.active or state.needs_build:
+        return
+    spec = state.spec
+    if "write" not in state.done:
+        updated = set_fields(state.original, state.values, spec.name)
+        write_atomic(spec.path, updated)
+        JOURNAL.record(spec.name, "write", state.values)
+        print(f"{spec.name} -> {state.pinned}")
+    if spec.after_write is not None:
+        spec.after_write()
+    JOURNAL.finish(spec.name)
+
+
+def _npm_build(states: Sequence[TargetState], snapshot: dict[str, str]) -> None:
+    """Resolve every npmDepsHash the direct path could not, in one nix build.
+
+    The FAKE_SRI edits only ever exist in a throwaway copy of the flake, so
+    the working tree is untouched until _write lands the real hash.
+    """
+    waiting = [state for state in states if state.active and state.needs_build]
+    if not waiting:
+        return
 
-def compute_scrypted_npm_hash() -> str:
+    hashes: dict[str, str] = {}
+    error = "nix build reported no npmDepsHash mismatch"
+    try:
+        with tempfile.TemporaryDirectory(prefix="update-pins-") as tmp:
+            workspace = Path(tmp)
+            stage_workspace(workspace, snapshot)
+            pending = []
+            for state in waiting:
+                npm_deps = state.spec.npm_deps
+                assert npm_deps is not None
+                staged = set_fields(
+                    state.original,
+                    {**state.values, npm_deps.binding: FAKE_SRI},
+                    state.spec.name,
+                )
+                relative = state.spec.path.relative_to(REPO_ROOT)
+                (workspace / relative).write_text(staged, encoding="utf-8")
+                pname = state.spec.name
+                pending.append(
+                    PendingNpmHash(pname, relative, f"{pname}-{state.version}-npm-deps")
+                )
+            hashes = compute_npm_hashes(pending, workspace)
+    except (UpdateError, OSError) as exc:
+        error = str(exc) or type(exc).__name__
+    for state in waiting:
+        if state.error:
+            # execute gave up on this step (timed out) while nix was running.
+            continue
+        npm_deps = state.spec.npm_deps
+        assert npm_deps is not None
+        if state.spec.name in hashes:
+            if state.unconfirmed_npm is not None:
+                direct, shape = state.unconfirmed_npm
+                NPM_SHAPES.put(shape, direct == hashes[state.spec.name])
+                if direct != hashes[state.spec.name]:
+                    print(
+                        f"warning: {state.spec.name}: direct npmDepsHash {direct} "
+                        f"!= fetchNpmDeps {hashes[state.spec.name]} for {shape}; "
+                        "always using nix for it",
+                        file=sys.stderr,
+                    )
+            state.values[npm_deps.binding] = hashes[state.spec.name]
+            state.needs_build = False
+            JOURNAL.record(state.spec.name, "npm", state.values)
+            try:
+                _write(state)
+            except (UpdateError, OSError) as exc:
+                state.error = str(exc) or type(exc).__name__
+        else:
+            state.error = error
+        state.finished = time.monotonic()
+
+
+def _pinned_tags(spec: PinSpec, text: str) -> tuple[str, list[str]]:
+    """Return the pinned version and the tags it may have been released as."""
+    current = read_field(text, spec.version_field, spec.name)
+    if spec.pin_tag:
+        return current, [current]
+    if spec.source == "npm":
+        return current, [spec.tag_format.format(version=current)]
+    return current, [f"{prefix}{current}" for prefix in spec.tag_prefixes] or [current]
+
+
+def _verify_asset(spec: PinSpec, text: str, asset: Asset) -> str:
+    """Re-hash one pinned asset with archive_sri; return a report line."""
+    current, tags = _pinned_tags(spec, text)
+    pinned = read_field(text, asset.binding, spec.name)
+    label = f"{spec.name} {asset.binding}"
+    for tag in tags:
+        url = spec.url(asset.url, tag, current)
+        try:
+            with HTTP.stream(url) as body:
+                sri = archive_sri(body, asset.strip_root)
+        except HttpError as exc:
+            if exc.status == 404:
+                continue
+            raise
+        if sri != pinned:
+            raise HashMismatch(f"{label}: pinned {pinned}, computed {sri}")
+        return f"  {label:<30} ok  {sri}"
+    raise UpdateError(f"{label}: no archive found for {current}")
+
+
+def _verify_npm_deps(spec: PinSpec, text: str, npm_deps: NpmDeps) -> str:
+    """Re-hash the pinned lockfile with npm_deps_hash; return a report line."""
+    current, tags = _pinned_tags(spec, text)
+    pinned = read_field(text, npm_deps.binding, spec.name)
+    label = f"{spec.name} {npm_deps.binding}"
+    for tag in tags:
+        try:
+            lock_text = fetch_bytes(spec.url(npm_deps.lock_url, tag, current))
+        except HttpError as exc:
+            if exc.status == 404:
+                continue
+            raise
+        lock = lock_text.decode("utf-8")
+        if npm_deps.fixup is not None:
+            lock = npm_deps.fixup(lock)
+        sri = npm_deps_hash(lock)
+        if sri != pinned:
+            raise HashMismatch(f"{label}: pinned {pinned}, computed {sri}")
+        return f"  {label:<30} ok  {sri}"
+    raise UpdateError(f"{label}: no package-lock.json found for {current}")
+
+
+def _nix_tree_sri(archive: Path, strip_root: bool) -> str:
+    """Unpack archive with tar as fetchzip does and have nix hash the tree."""
+    with tempfile.TemporaryDirectory(prefix="hasher-fixture-") as tmp:
+        out = Path(tmp)
+        run(["tar", "-xzf", str(archive), "-C", str(out)])
+        if strip_root:
+            entries = list(out.iterdir())
+            if len(entries) != 1 or not entries[0].is_dir():
+                raise UpdateError(f"{archive.name}: expected one top-level directory")
+            out = entries[0]
+        return run(["nix", "hash", "path", str(out)]).stdout.strip()
+
+
+def record_hasher_fixtures() -> int:
+    """Record nix's hash of every fixture tarball in HASHER_FIXTURES_PATH."""
     if not which("nix"):
-        raise UpdateError("nix is required to compute Scrypted npmDepsHash.")
-
-    expr = "\n".join(
-        [
-            "let",
-            "  flake = builtins.getFlake (toString ./.);",
-            "  overlaySkipNodeChecks = final: prev: {",
-            "    nodejs_20 = prev.nodejs_20.overrideAttrs (_: { doCheck = false; });",
-            "    nodejs_22 = prev.nodejs_22.overrideAttrs (_: { doCheck = false; });",
-            "  };",
-            "  pkgs = import flake.inputs.nixpkgs {",
-            "    system = builtins.currentSystem;",
-            "    overlays = [overlaySkipNodeChecks];",
-            "  };",
-            "in pkgs.callPackage ./pkgs/scrypted.nix {}",
-        ]
-    )
-    build = subprocess.run(
-        ["nix", "build", "--impure", "--expr", expr, "--no-link"],
-        text=True,
-        capture_output=True,
-        cwd=REPO_ROOT,
-    )
-    output = f"{build.stdout}\n{build.stderr}"
-    if build.returncode == 0:
-        raise UpdateError(
-            "nix build succeeded, expected Scrypted npmDepsHash mismatch."
+        print("error: nix is required to record hasher fixtures.", file=sys.stderr)
+        return 1
+    fixtures = json.loads(HASHER_FIXTURES_PATH.read_text(encoding="utf-8"))
+    for name, entry in fixtures.items():
+        entry["hash"] = _nix_tree_sri(
+            HASHER_FIXTURES_DIR / name, bool(entry["strip_root"])
         )
-
-    matches = re.findall(r"sha256-[A-Za-z0-9+/=]+", output)
-    if not matches:
-        raise UpdateError("Failed to locate Scrypted npmDepsHash in nix build output.")
-    return matches[-1]
+        print(f"  {name:<30} {entry['hash']}")
+    write_atomic(
+        HASHER_FIXTURES_PATH, json.dumps(fixtures, indent=2, sort_keys=True) + "\n"
+    )
+    return 0
 
 
-def update_scrypted() -> None:
-    latest = fetch_json("https://registry.npmjs.org/@scrypted%2Fserver/latest")
-    latest_version = latest.get("version")
-    if not isinstance(latest_version, str) or not latest_version:
+def _verify_fixture(name: str, entry: dict[str, object]) -> str:
+    """Hash one fixture tarball with archive_sri; return a report line."""
+    label = f"fixture {name}"
+    recorded = str(entry.get("hash") or "")
+    if not recorded:
         raise UpdateError(
-            "Could not find latest @scrypted/server version in npm registry response."
+            f"{label}: no nix hash recorded; run --record-hasher-fixtures"
+        )
+    with (HASHER_FIXTURES_DIR / name).open("rb") as body:
+        sri = archive_sri(body, bool(entry["strip_root"]))
+    if sri != recorded:
+        raise HashMismatch(f"{label}: nix {recorded}, computed {sri}")
+    return f"  {label:<30} ok  {sri}"
+
+
+def verify_hasher(names: Sequence[str]) -> int:
+    """Check the nix-free hashers against hashes nix computed.
+
+    The fixture tarballs are checked offline against the hashes nix recorded
+    for them; then pinned archives go through archive_sri and lockfiles
+    through npm_deps_hash against the hashes pinned.
+    """
+    fixtures = json.loads(HASHER_FIXTURES_PATH.read_text(encoding="utf-8"))
+    jobs: list[Callable[[], str]] = [
+        partial(_verify_fixture, name, entry) for name, entry in fixtures.items()
+    ]
+    for name in names:
+        spec = PINS[name]
+        text = spec.path.read_text(encoding="utf-8")
+        jobs.extend(partial(_verify_asset, spec, text, asset) for asset in spec.assets)
+        if spec.npm_deps is not None:
+            jobs.append(partial(_verify_npm_deps, spec, text, spec.npm_deps))
+    failed = False
+    with ThreadPoolExecutor(max_workers=PREFETCH_JOBS) as pool:
+        futures = [pool.submit(job) for job in jobs]
+        for future in futures:
+            try:
+                print(future.result())
+            except HashMismatch as exc:
+                failed = True
+                print(f"  mismatch: {exc}")
+            except (
+                UpdateError,
+                OSError,
+                ValueError,
+                KeyError,
+                http.client.HTTPException,
+            ) as exc:
+                # Network and DNS failures say nothing about the hashers.
+                failed = True
+                print(f"  error: {exc}")
+    return 1 if failed else 0
+
+
+def plan_check(names: Sequence[str]) -> Plan:
+    """Plan only the latest-version lookups, with no prefetch or nix work."""
+    states = {name: TargetState(PINS[name]) for name in names}
+    steps = {
+        f"lookup:{name}": Step(
+            f"lookup:{name}", "lookup", partial(_lookup, state), targets=(name,)
+        )
+        for name, state in states.items()
+    }
+    return Plan(states, steps)
+
+
+def report_check(plan: Plan) -> int:
+    """Print a staleness report; return CHECK_CURRENT/OUTDATED/FAILED."""
+    outdated = failed = False
+    for name, state in plan.states.items():
+        if state.error:
+            failed = True
+            print(f"  {name:<11} error     {state.error}")
+        elif state.up_to_date:
+            print(f"  {name:<11} current   {state.current}")
+        else:
+            outdated = True
+            print(f"  {name:<11} outdated  {state.current} -> {state.pinned}")
+    if failed:
+        return CHECK_FAILED
+    return CHECK_OUTDATED if outdated else CHECK_CURRENT
+
+
+def plan_updates(names: Sequence[str]) -> Plan:
+    """Lay out every lookup, prefetch, npm hash and write as a step graph."""
+    states = {name: TargetState(PINS[name]) for name in names}
+    steps: dict[str, Step] = {}
+
+    def add(step: Step) -> None:
+        steps[step.id] = step
+
+    for name, state in states.items():
+        spec = state.spec
+        resolve_id = f"resolve:{name}"
+        add(Step(resolve_id, "resolve", partial(_resolve, state), targets=(name,)))
+        write_deps = [resolve_id]
+        if spec.assets:
+            add(
+                Step(
+                    f"prefetch:{name}",
+                    "prefetch",
+                    partial(_prefetch, state),
+                    (resolve_id,),
+                    (name,),
+                )
+            )
+            write_deps.append(f"prefetch:{name}")
+        if spec.npm_deps is not None:
+            add(
+                Step(
+                    f"npm:{name}",
+                    "npm",
+                    partial(_npm_hash, state),
+                    (resolve_id,),
+                    (name,),
+                )
+            )
+            write_deps.append(f"npm:{name}")
+        add(
+            Step(
+                f"write:{name}",
+                "write",
+                partial(_write, state),
+                tuple(write_deps),
+                (name,),
+            )
         )
 
-    original_text = SCRYPTED_PATH.read_text(encoding="utf-8")
-
-    version_match = re.search(r'^\s*version = "([^"]+)";', original_text, re.M)
-    if not version_match:
-        raise UpdateError("Could not find Scrypted version in pkgs/scrypted.nix")
-
-    current_version = version_match.group(1)
-    if current_version == latest_version:
-        print(f"scrypted already at {latest_version}")
-        return
-
-    src_url = (
-        f"https://github.com/koush/scrypted/archive/refs/tags/v{latest_version}.tar.gz"
+    npm_targets = tuple(
+        name for name, state in states.items() if state.spec.npm_deps is not None
     )
-    src_hash = prefetch_sri(src_url)
+    if npm_targets:
+        deps = [
+            step.id
+            for step in steps.values()
+            if step.kind in ("prefetch", "npm") and step.targets[0] in npm_targets
+        ]
+        add(
+            Step(
+                "npm-build",
+                "npm-build",
+                partial(
+                    _npm_build,
+                    [states[name] for name in npm_targets],
+                    snapshot_flake(),
+                ),
+                tuple(deps),
+                npm_targets,
+            )
+        )
+    return Plan(states, steps)
+
+
+def execute(plan: Plan, jobs: int, timeout: float) -> None:
+    """Run plan's steps as a DAG on a bounded pool.
+
+    A step starts as soon as its own dependencies are done. Each target's
+    deadline starts with its first step; a failed target's later steps are
+    skipped while other targets carry on.
+    """
+    states = plan.states
+    waiting = {step_id: set(step.deps) for step_id, step in plan.steps.items()}
+    dependents: dict[str, list[str]] = {step_id: [] for step_id in plan.steps}
+    for step_id, step in plan.steps.items():
+        for dep in step.deps:
+            dependents[dep].append(step_id)
+
+    deadlines: dict[str, float] = {}
+
+    def run_step(step: Step) -> None:
+        # Clocks start when a worker picks the step up, not while it queues.
+        now = time.monotonic()
+        starts = []
+        for name in step.targets:
+            state = states[name]
+            if state.started is None:
+                state.started = now
+            starts.append(state.started)
+        deadlines[step.id] = max(starts, default=now) + timeout
+        _deadline.set(deadlines[step.id])
+        _target.set(",".join(step.targets) or None)
+        with TRACER.span(f"step:{step.kind}", step.id):
+            step.action()
+
+    def finish(step: Step, error: str) -> None:
+        if len(step.targets) != 1:
+            # Shared steps record their own per-target outcome, unless they
+            # crashed or timed out first: then every target still waiting on
+            # them fails, and a late-finishing thread cannot write for it.
+            for name in step.targets:
+                state = states[name]
+                if error and state.needs_build and not state.error:
+                    state.error = error
+                    state.finished = time.monotonic()
+            return
+        state = states[step.targets[0]]
+        if error and not state.error:
+            state.error = error
+        state.finished = time.monotonic()
+
+    def complete(step: Step) -> None:
+        for dependent in dependents[step.id]:
+            waiting[dependent].discard(step.id)
+            if not waiting[dependent]:
+                ready.append(dependent)
+
+    executor = ThreadPoolExecutor(max_workers=max(1, jobs))
+    running: dict[Future[None], Step] = {}
+    ready = [step_id for step_id, deps in waiting.items() if not deps]
+    try:
+        while ready or running:
+            while ready:
+                step = plan.steps[ready.pop(0)]
+                if step.targets and all(states[n].error for n in step.targets):
+                    complete(step)
+                    continue
+                ctx = contextvars.copy_context()
+                running[executor.submit(ctx.run, run_step, step)] = step
+
+            done, _ = wait(running, timeout=1.0, return_when=FIRST_COMPLETED)
+            now = time.monotonic()
+            for future in done:
+                step = running.pop(future)
+                exc = future.exception()
+                finish(step, "" if exc is None else str(exc) or type(exc).__name__)
+                complete(step)
+            # Subprocesses and HTTP calls honour the deadline themselves; this
+            # only catches a step stuck somewhere that cannot be interrupted.
+            for future, step in list(running.items()):
+                step_deadline = deadlines.get(step.id)
+                if step_deadline is not None and now > step_deadline + 5:
+                    del running[future]
+                    finish(step, "timed out")
+                    complete(step)
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+def _jittered(delay: float) -> float:
+    return delay * random.uniform(1 - WATCH_JITTER, 1 + WATCH_JITTER)
+
+
+def watch(
+    names: Sequence[str],
+    jobs: int,
+    timeout: float,
+    interval: float | None,
+    dry_run: bool,
+) -> int:
+    """Poll each upstream on its own schedule and update what changed.
+
+    Runs until interrupted. Tags are always looked up fresh, but the HTTP
+    connections, ETags and prefetched archive hashes stay warm in memory
+    between polls. A target is only rescheduled once its lookup (and any
+    update it triggered) has finished, so a slow upstream cannot pile up
+    requests; failures back off exponentially.
+    """
+    # Polls always ask upstream; the update that follows reuses that answer.
+    TAG_CACHE.mode = "refresh"
+    failures = dict.fromkeys(names, 0)
+    now = time.monotonic()
+    due = [(now, name) for name in names]
+    heapq.heapify(due)
+
+    def stamp() -> str:
+        return time.strftime("%H:%M:%S")
 
-    updated = replace_one(
-        r'^(\s*version = ")[^"]+(";)',
-        rf"\g<1>{latest_version}\g<2>",
-        original_text,
-        "scrypted version",
+    try:
+        while True:
+            when, _ = due[0]
+            time.sleep(max(0.0, when - time.monotonic()))
+            now = time.monotonic()
+            ready = []
+            while due and due[0][0] <= now:
+                ready.append(heapq.heappop(due)[1])
+            ordered = [name for name in names if name in ready]
+
+            check = plan_check(ordered)
+            execute(check, len(ordered), timeout)
+            outdated = []
+            for name in ordered:
+                state = check.states[name]
+                if state.error:
+                    failures[name] += 1
+                    print(f"{stamp()} {name}: lookup failed: {state.error}")
+                elif not state.up_to_date:
+                    print(f"{stamp()} {name}: {state.current} -> {state.pinned}")
+                    outdated.append(name)
+                else:
+                    failures[name] = 0
+
+            if outdated and not dry_run:
+                TAG_CACHE.mode = "use"
+                update(outdated, jobs, timeout)
+                TAG_CACHE.mode = "refresh"
+                for name in outdated:
+                    state = check.states[name]
+                    try:
+                        after = state.spec.path.read_text(encoding="utf-8")
+                        pinned = read_field(after, state.spec.version_field, name)
+                    except (UpdateError, OSError) as exc:
+                        print(f"{stamp()} {name}: cannot read the new pin: {exc}")
+                        pinned = ""
+                    if pinned == state.pinned:
+                        failures[name] = 0
+                    else:
+                        failures[name] += 1
+                PREFETCH_CACHE.save()
+            sys.stdout.flush()
+
+            for name in ordered:
+                period = interval or PINS[name].poll_interval
+                if failures[name]:
+                    period = min(period, WATCH_RETRY * 2 ** (failures[name] - 1))
+                heapq.heappush(due, (time.monotonic() + _jittered(period), name))
+            TRACER.clear()
+    except KeyboardInterrupt:
+        return 0
+
+
+def parse_watch_args(argv: Sequence[str]) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        prog="update-pins.py watch",
+        description="Keep polling upstreams and update pins when they change.",
     )
-    updated = replace_one(
-        r'^(\s*srcHash = ")[^"]+(";)',
-        rf"\g<1>{src_hash}\g<2>",
-        updated,
-        "scrypted srcHash",
+    parser.add_argument(
+        "targets",
+        nargs="*",
+        choices=[*sorted(PINS), "all"],
+        default=["all"],
+        help="Targets to watch (default: all).",
     )
-
-    with_fake = replace_one(
-        r"^(\s*npmDepsHash = ).*?;",
-        rf'\g<1>"{FAKE_SRI}";',
-        updated,
-        "scrypted npmDepsHash",
+    parser.add_argument(
+        "--interval",
+        type=float,
+        help="Seconds between polls for every target (default: per target).",
     )
-
-    SCRYPTED_PATH.write_text(with_fake, encoding="utf-8")
-
-    try:
-        npm_hash = compute_scrypted_npm_hash()
-    except Exception:
-        SCRYPTED_PATH.write_text(original_text, encoding="utf-8")
-        raise
-
-    final_text = replace_one(
-        r"^(\s*npmDepsHash = ).*?;",
-        rf'\g<1>"{npm_hash}";',
-        updated,
-        "scrypted npmDepsHash",
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=DEFAULT_JOBS,
+        help=f"Maximum targets to update at once (default: {DEFAULT_JOBS}).",
     )
-
-    SCRYPTED_PATH.write_text(final_text, encoding="utf-8")
-    print(f"scrypted -> {latest_version}")
-
-
-def update_mole() -> None:
-    tags = get_tags("https://github.com/tw93/Mole.git")
-    latest_tag = select_latest_tag(tags, preferred_prefixes=("V", "v"))
-    if not latest_tag:
-        raise UpdateError("No Mole tags found.")
-
-    version = latest_tag.lstrip("vV")
-    original_text = MOLE_PATH.read_text(encoding="utf-8")
-
-    version_match = re.search(r'^\s*version = "([^"]+)";', original_text, re.M)
-    if not version_match:
-        raise UpdateError("Could not find Mole version in pkgs/mole.nix")
-
-    current_version = version_match.group(1)
-    if current_version == version:
-        print(f"mole already at {version}")
-        return
-
-    src_url = f"https://github.com/tw93/Mole/archive/refs/tags/{latest_tag}.tar.gz"
-    binaries_arm_url = (
-        "https://github.com/tw93/Mole/releases/download/"
-        f"{latest_tag}/binaries-darwin-arm64.tar.gz"
+    parser.add_argument(
+        "--timeout",
+        type=float,
+        default=DEFAULT_TIMEOUT,
+        help=f"Wall-clock seconds allowed per target (default: {DEFAULT_TIMEOUT:g}).",
     )
-    binaries_amd_url = (
-        "https://github.com/tw93/Mole/releases/download/"
-        f"{latest_tag}/binaries-darwin-amd64.tar.gz"
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="Only report upstream changes; never update.",
     )
+    return parser.parse_args(argv)
 
-    src_hash = prefetch_sri(src_url)
-    binaries_hash_arm = prefetch_sri(binaries_arm_url)
-    binaries_hash_amd = prefetch_sri(binaries_amd_url)
 
-    updated = replace_one(
-        r'^(\s*version = ")[^"]+(";)',
-        rf"\g<1>{version}\g<2>",
-        original_text,
-        "mole version",
+def parse_args(argv: Sequence[str]) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description="Update pinned tags and hashes.",
+        epilog="Run `update-pins.py watch --help` for the long-running mode.",
+    )
+    parser.add_argument(
+        "targets",
+        nargs="+",
+        choices=[*sorted(PINS), "all", "flakes"],
+        help=(
+            "Targets to update. `flakes` instead updates the sibling repos' "
+            "flake.lock files, then this repo's."
+        ),
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=DEFAULT_JOBS,
+        help=f"Maximum targets to update at once (default: {DEFAULT_JOBS}).",
+    )
+    parser.add_argument(
+        "--check",
+        action="store_true",
+        help=(
+            "Only look up the latest versions and report what is out of date. "
+            f"Exits {CHECK_CURRENT} when current, {CHECK_OUTDATED} when "
+            f"outdated, {CHECK_FAILED} when a lookup failed."
+        ),
     )
-    updated = replace_one(
-        r'^(\s*srcHash = ")[^"]+(";)',
-        rf"\g<1>{src_hash}\g<2>",
-        updated,
-        "mole srcHash",
+    parser.add_argument(
+        "--verify-hasher",
+        action="store_true",
+        help=(
+            "Re-hash the fixture tarballs, the currently pinned archives and "
+            "npm dependencies without nix and compare them with nix's hashes."
+        ),
+    )
+    parser.add_argument(
+        "--record-hasher-fixtures",
+        action="store_true",
+        help="Record nix's hash of each fixture tarball for --verify-hasher.",
+    )
+    parser.add_argument(
+        "--plan",
+        action="store_true",
+        help="Print the planned steps and their dependencies, then exit.",
+    )
+    parser.add_argument(
+        "--trace",
+        type=Path,
+        metavar="PATH",
+        help="Write a Chrome trace-event JSON file of every step and call.",
+    )
+    parser.add_argument(
+        "--timeout",
+        type=float,
+        default=DEFAULT_TIMEOUT,
+        help=f"Wall-clock seconds allowed per target (default: {DEFAULT_TIMEOUT:g}).",
+    )
+    cache = parser.add_mutually_exclusive_group()
+    cache.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="Bypass the on-disk prefetch, tag, HTTP and lock caches.",
+    )
+    cache.add_argument(
+        "--verify-cache",
+        action="store_true",
+        help="Re-hash cached archives and report any that changed.",
+    )
+    parser.add_argument(
+        "--verify-lock",
+        action="store_true",
+        help=(
+            "After writing flake.lock's codex node directly, re-lock it with "
+            "`nix flake update` and fail if the two disagree."
+        ),
     )
-    updated = replace_one(
-        r'^(\s*binariesHashArm64 = ")[^"]+(";)',
-        rf"\g<1>{binaries_hash_arm}\g<2>",
-        updated,
-        "mole binariesHashArm64",
+    parser.add_argument(
+        "--fresh",
+        action="store_true",
+        help="Ignore steps a previous failed run finished and start over.",
     )
-    updated = replace_one(
-        r'^(\s*binariesHashAmd64 = ")[^"]+(";)',
-        rf"\g<1>{binaries_hash_amd}\g<2>",
-        updated,
-        "mole binariesHashAmd64",
+    parser.add_argument(
+        "--verify-build",
+        action="store_true",
+        help=(
+            "Build every updated package within the host's nix max-jobs and "
+            "roll back any that fail."
+        ),
     )
+    args = parser.parse_args(argv)
+    if "flakes" in args.targets and len(set(args.targets)) > 1:
+        parser.error("flakes cannot be combined with other targets")
+    return args
 
-    MOLE_PATH.write_text(updated, encoding="utf-8")
-    print(f"mole -> {version}")
 
+def nix_build_limits() -> tuple[int, int]:
+    """The host's nix (max-jobs, cores); cores 0 means every core."""
+    settings: dict[str, str] = {}
+    for cmd in (["nix", "config", "show"], ["nix", "show-config"]):
+        result = run(cmd, check=False)
+        if result.returncode == 0:
+            for line in result.stdout.splitlines():
+                key, sep, value = line.partition(" = ")
+                if sep:
+                    settings[key.strip()] = value.strip()
+            break
+    max_jobs = settings.get("max-jobs", "1")
+    cores = settings.get("cores", "0")
+    return (
+        (os.cpu_count() or 1) if max_jobs == "auto" else int(max_jobs or 1),
+        int(cores or 0),
+    )
 
-def update_ramp() -> None:
-    tags = get_tags("https://github.com/ramp-public/ramp-cli.git")
-    latest_tag = select_latest_tag(tags, preferred_prefixes=("v",))
-    if not latest_tag.startswith("v"):
-        raise UpdateError(f"Unexpected Ramp tag format: {latest_tag}")
 
-    version = latest_tag[1:]
-    original_text = RAMP_CLI_PATH.read_text(encoding="utf-8")
+def derivations(states: Sequence[TargetState], workspace: Path) -> dict[str, str]:
+    """Instantiate every package in one evaluation of workspace.
 
-    version_match = re.search(r'^\s*version = "([^"]+)";', original_text, re.M)
-    if not version_match:
-        raise UpdateError("Could not find Ramp CLI version in pkgs/ramp-cli.nix")
+    Maps each target to its .drv path, or "" when the package is not
+    available on this host's platform.
+    """
+    expr = _pkgs_expr(
+        f"{state.spec.name} = let p = pkgs.callPackage "
+        f"./{state.spec.path.relative_to(REPO_ROOT)} {{}}; in "
+        'if pkgs.lib.meta.availableOn pkgs.stdenv.hostPlatform p then p.drvPath else "";'
+        for state in states
+    )
+    result = run(["nix", "eval", "--impure", "--json", "--expr", expr], cwd=workspace)
+    return json.loads(result.stdout)
 
-    current_version = version_match.group(1)
-    if current_version == version:
-        print(f"ramp already at {version}")
-        return
 
-    src_url = (
-        f"https://github.com/ramp-public/ramp-cli/archive/refs/tags/{latest_tag}.tar.gz"
-    )
-    src_hash = prefetch_sri(src_url)
+def verify_builds(states: Sequence[TargetState], timeout: float) -> dict[str, str]:
+    """Build each updated package, rolling failures back to their old pin.
 
-    updated = replace_one(
-        r'^(\s*version = ")[^"]+(";)',
-        rf"\g<1>{version}\g<2>",
-        original_text,
-        "ramp version",
-    )
-    updated = replace_one(
-        r'^(\s*hash = ")[^"]+(";)',
-        rf"\g<1>{src_hash}\g<2>",
-        updated,
-        "ramp hash",
+    Every package is evaluated once, in a staged copy of the flake, so
+    rollbacks rewriting the live tree cannot change what the other builds
+    see; the builds then realise the .drv files directly. They share the
+    host's max-jobs, and only as many run at once as the host's cores
+    allow at its cores setting. Returns a short outcome per target.
+    """
+    if not states:
+        return {}
+    if not which("nix"):
+        raise UpdateError("nix is required to verify builds.")
+
+    with (
+        TRACER.span("build", "eval"),
+        tempfile.TemporaryDirectory(prefix="update-pins-") as tmp,
+    ):
+        stage_workspace(Path(tmp), snapshot_flake())
+        drvs = derivations(states, Path(tmp))
+    outcomes = {
+        state.spec.name: "skipped (unsupported platform)"
+        for state in states
+        if not drvs.get(state.spec.name)
+    }
+    pending = [state for state in states if state.spec.name not in outcomes]
+    if not pending:
+        return outcomes
+
+    max_jobs, cores = nix_build_limits()
+    cpus = os.cpu_count() or 1
+    # cores 0 lets each derivation use every core.
+    concurrency = max(1, min(max_jobs, len(pending), cpus // (cores or cpus)))
+    per_build = str(max(1, max_jobs // concurrency))
+    print(
+        f"verifying {len(pending)} build(s), {concurrency} at a time "
+        f"(max-jobs {max_jobs}, cores {cores or 'all'})"
     )
 
-    RAMP_CLI_PATH.write_text(updated, encoding="utf-8")
-    print(f"ramp -> {version}")
+    def build(state: TargetState) -> str:
+        spec = state.spec
+        _deadline.set(time.monotonic() + timeout)
+        _target.set(spec.name)
+        started = time.monotonic()
+        try:
+            with TRACER.span("build", spec.name):
+                result = run(
+                    [
+                        "nix",
+                        "build",
+                        "--no-link",
+                        "--max-jobs",
+                        per_build,
+                        f"{drvs[spec.name]}^*",
+                    ],
+                    check=False,
+                )
+            detail = (result.stderr.strip().splitlines()[-1:] or [""])[0]
+            failed = result.returncode != 0
+        except UpdateError as exc:
+            detail, failed = str(exc), True
+        if failed:
+            write_atomic(spec.path, state.original)
+            state.error = f"build failed, rolled back to {state.current}: {detail}"
+            return "failed, rolled back"
+        return f"ok {time.monotonic() - started:6.1f}s"
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = {state.spec.name: executor.submit(build, state) for state in pending}
+    outcomes.update((name, future.result()) for name, future in futures.items())
+    return outcomes
+
+
+def update(
+    ordered: Sequence[str], jobs: int, timeout: float, verify_build: bool = False
+) -> int:
+    """Plan and run updates for ordered, then print a summary; 1 on failure.
+
+    With verify_build, every package written under pkgs/ is then built and
+    rolled back if the build fails.
+    """
+    plan = plan_updates(ordered)
+    try:
+        execute(plan, jobs, timeout)
+    finally:
+        PREFETCH_CACHE.save()
+
+    states = plan.states
+    if verify_build:
+        written = [
+            states[name]
+            for name in ordered
+            if states[name].active
+            and states[name].spec.path.parent == PKGS_DIR
+            and states[name].spec.path.read_text(encoding="utf-8")
+            != states[name].original
+        ]
+        try:
+            outcomes = verify_builds(written, timeout)
+        except UpdateError as exc:
+            print(f"error: build verification: {exc}", file=sys.stderr)
+            return 1
+        for name, outcome in outcomes.items():
+            print(f"build: {name}: {outcome}")
+    if len(ordered) > 1:
+        print("summary:")
+        for name in ordered:
+            state = states[name]
+            status = "failed" if state.error else "ok"
+            seconds = (state.finished or 0) - (state.started or 0)
+            print(f"  {name:<11} {status:<7} {seconds:6.1f}s")
+    print("phases:")
+    print(TRACER.summary())
+    sys.stdout.flush()
+
+    failed = [name for name in ordered if states[name].error]
+    for name in failed:
+        print(f"error: {name}: {states[name].error}", file=sys.stderr)
+    return 1 if failed else 0
+
+
+def update_sibling_flake(repo: Path) -> str:
+    """Update repo's flake.lock and push it to main if it changed."""
+    if not repo.is_dir():
+        raise UpdateError(f"missing repo: {repo}")
+    if run(["git", "status", "--porcelain"], cwd=repo).stdout.strip():
+        raise UpdateError("working tree is dirty, refusing auto-commit")
+    run(["nix", "flake", "update"], cwd=repo)
+    diff = run(["git", "diff", "--quiet", "--", "flake.lock"], check=False, cwd=repo)
+    if diff.returncode == 0:
+        return "flake.lock unchanged, skipping commit/push"
+    run(["git", "add", "flake.lock"], cwd=repo)
+    run(["git", "commit", "-m", FLAKE_UPDATE_MESSAGE], cwd=repo)
+    run(["git", "push", "origin", "HEAD:main"], cwd=repo)
+    return "pushed flake.lock to main"
+
+
+def update_flakes(timeout: float) -> int:
+    """Update the sibling flakes concurrently, then this repo's flake.lock.
+
+    This repo is skipped if any sibling fails, since it would lock a stale
+    input. Prints how long each repo took; 1 on failure.
+    """
+    results: dict[str, tuple[str, str, float]] = {}
+
+    def update_one(repo: Path, action: Callable[[], str]) -> None:
+        _deadline.set(time.monotonic() + timeout)
+        _target.set(repo.name)
+        started = time.monotonic()
+        try:
+            with TRACER.span("flake-update", repo.name):
+                outcome = ("ok", action())
+        except (UpdateError, OSError) as exc:
+            outcome = ("failed", str(exc) or type(exc).__name__)
+        results[repo.name] = (*outcome, time.monotonic() - started)
+        print(f"{repo.name}: {outcome[1]}")
+        sys.stdout.flush()
+
+    with ThreadPoolExecutor(max_workers=len(SIBLING_FLAKES)) as executor:
+        futures = [
+            executor.submit(update_one, repo, partial(update_sibling_flake, repo))
+            for repo in SIBLING_FLAKES
+        ]
+        for future in futures:
+            future.result()
 
+    # Every sibling must have reported ok, not merely not failed.
+    if all(results.get(repo.name, ("",))[0] == "ok" for repo in SIBLING_FLAKES):
 
-def parse_args(argv: Sequence[str]) -> argparse.Namespace:
-    parser = argparse.ArgumentParser(description="Update pinned tags and hashes.")
-    parser.add_argument(
-        "targets",
-        nargs="+",
-        choices=["codex", "homebridge", "mole", "ramp", "scrypted", "all"],
-        help="Targets to update.",
-    )
-    return parser.parse_args(argv)
+        def update_self() -> str:
+            run(["nix", "flake", "update"], cwd=REPO_ROOT)
+            return "flake.lock updated"
+
+        update_one(REPO_ROOT, update_self)
+
+    print("summary:")
+    for repo in (*SIBLING_FLAKES, REPO_ROOT):
+        status, _, seconds = results.get(repo.name, ("skipped", "", 0.0))
+        print(f"  {repo.name:<11} {status:<7} {seconds:6.1f}s")
+    sys.stdout.flush()
+
+    failed = [name for name, (status, _, _) in results.items() if status != "ok"]
+    for name in failed:
+        print(f"error: {name}: {results[name][1]}", file=sys.stderr)
+    return 1 if failed else 0
 
 
 def main(argv: Sequence[str]) -> int:
+    if argv[:1] == ["watch"]:
+        args = parse_watch_args(argv[1:])
+        targets = set(args.targets)
+        ordered = [name for name in PINS if "all" in targets or name in targets]
+        return watch(ordered, args.jobs, args.timeout, args.interval, args.dry_run)
+
     args = parse_args(argv)
+    if args.targets[0] == "flakes":
+        try:
+            return update_flakes(args.timeout)
+        finally:
+            if args.trace is not None:
+                TRACER.write_chrome_trace(args.trace)
+
     targets = set(args.targets)
     if "all" in targets:
-        targets = {"codex", "homebridge", "mole", "ramp", "scrypted"}
-
+        targets = set(PINS)
+    if args.no_cache:
+        PREFETCH_CACHE.mode = "off"
+        TAG_CACHE.mode = "off"
+        ETAG_CACHE.mode = "off"
+        LOCK_CACHE.mode = "off"
+    elif args.verify_cache:
+        PREFETCH_CACHE.mode = "verify"
+    if args.verify_lock:
+        LOCK_CACHE.mode = "verify"
+    if args.fresh:
+        JOURNAL.clear()
+
+    ordered = [name for name in PINS if name in targets]
+    if args.record_hasher_fixtures:
+        return record_hasher_fixtures()
+    if args.verify_hasher:
+        return verify_hasher(ordered)
+    if args.check:
+        check = plan_check(ordered)
+        execute(check, len(ordered), args.timeout)
+        if args.trace is not None:
+            TRACER.write_chrome_trace(args.trace)
+        return report_check(check)
+
+    if args.plan:
+        print(plan_updates(ordered).describe())
+        return 0
     try:
-        if "codex" in targets:
-            update_codex()
-        if "homebridge" in targets:
-            update_homebridge()
-        if "scrypted" in targets:
-            update_scrypted()
-        if "mole" in targets:
-            update_mole()
-        if "ramp" in targets:
-            update_ramp()
-    except UpdateError as exc:
-        print(f"error: {exc}", file=sys.stderr)
-        return 1
-    return 0
+        return update(ordered, args.jobs, args.timeout, args.verify_build)
+    finally:
+        if args.trace is not None:
+            TRACER.write_chrome_trace(args.trace)
 
 
 if __name__ == "__main__":